@@ -0,0 +1,80 @@
+#!/usr/bin/env python2.7
+
+"""
+compare checking names against the exclusions one rule at a time (the way
+that sync used to) with the compiled Exclusions matcher
+"""
+
+import argparse
+import fnmatch
+import random
+import time
+
+from ftsdb import re # re or re2
+from ftsexclude import Exclusions
+
+ap = argparse.ArgumentParser()
+ap.add_argument('--entries', default=200000, type=int) # how many names to check
+ap.add_argument('--rules',   default=40,     type=int) # how many extra rules on top of the defaults
+ap.add_argument('--seed',    default=0,      type=int)
+ap.add_argument('--repeat',  default=3,      type=int) # report the best of this many runs
+
+args = ap.parse_args()
+
+rng = random.Random(args.seed)
+
+# the ones that a new database starts with
+rules = [('glob', '*.pyc'), ('glob', '*~'), ('glob', '*.o'),
+         ('simple', '.fts.db'), ('glob', '.fts.db-*'), ('simple', '.fts.sock'),
+         ('simple', '.svn'), ('simple', '.git'), ('simple', '.hg')]
+
+exts = ['c', 'h', 'py', 'js', 'txt', 'md', 'log', 'html', 'css', 'java', 'go', 'rs', 'pyc', 'o']
+words = ['src', 'lib', 'test', 'util', 'core', 'main', 'index', 'config', 'build',
+         'data', 'model', 'view', 'api', 'parse', 'cache', 'node_modules', 'vendor']
+
+for x in xrange(args.rules):
+    kind = x % 3
+    if kind == 0:
+        rules.append(('glob', '*.%s%d' % (rng.choice(exts), x)))
+    elif kind == 1:
+        rules.append(('simple', '%s%d' % (rng.choice(words), x)))
+    else:
+        rules.append(('re', r'(^|/)%s%d/' % (rng.choice(words), x)))
+
+entries = []
+for x in xrange(args.entries):
+    dirs = [rng.choice(words) for y in xrange(rng.randint(0, 4))]
+    basename = '%s%d.%s' % (rng.choice(words), rng.randint(0, 100), rng.choice(exts))
+    entries.append((basename, '/'.join(dirs + [basename])))
+
+def naive(rules, basename, dbpath):
+    for typ, pattern in rules:
+        if typ == 'simple':
+            if basename == pattern:
+                return False
+        elif typ == 'glob':
+            if fnmatch.fnmatch(basename, pattern):
+                return False
+        elif typ == 're':
+            if pattern.search(dbpath):
+                return False
+    return True
+
+def run(name, allow):
+    best = None
+    for x in xrange(args.repeat):
+        start = time.time()
+        allowed = sum(1 for basename, dbpath in entries if allow(basename, dbpath))
+        took = time.time() - start
+        best = took if best is None else min(best, took)
+    print "%-10s %8.3fs %10.0f entries/s (%d allowed)" % (name, best, len(entries)/best, allowed)
+    return best, allowed
+
+compiled = [(typ, re.compile(e) if typ == 're' else e) for typ, e in rules]
+exclusions = Exclusions(rules)
+
+print "%d entries, %d rules" % (len(entries), len(rules))
+before, naive_allowed = run('naive', lambda b, p: naive(compiled, b, p))
+after, compiled_allowed = run('compiled', exclusions.allow)
+assert naive_allowed == compiled_allowed
+print "%.1fx faster" % (before / after)
@@ -4,16 +4,27 @@ import sys
 import os
 import logging
 import argparse
+import glob
+import atexit
 
 from ftsdb import re # re or re2
 
-from ftsdb import logger, Cursor
-from ftsdb import finddb
+from ftsdb import logger, _db_name
+from ftsdb import finddb, findroot, opendb, with_shards, set_wal
 
 from ftsinit import init
 from ftssync import sync
+from ftsgit import git_sync
+from ftsoptimize import optimize, maintain, set_automerge, report, MAINTAIN_SECONDS
 from ftsexclude import add_ignore, list_ignores, rm_ignore
 from ftssearch import search
+from ftstrigrams import enable_trigrams, disable_trigrams
+from ftssniff import set_limits, skipped_report
+from ftswatch import watch
+from ftsserver import serve, connect_client, NoServer
+from ftscache import CACHE_ENTRIES
+from ftsfederate import find_indexes, federated_search, is_index
+from ftsstats import stats
 
 def main():
     ap = argparse.ArgumentParser('fts', description="a command line full text search engine")
@@ -23,9 +34,52 @@ def main():
 
     ap.add_argument("--init", action="store_true", help="Create a new .fts.db in the current directory")
     ap.add_argument("--no-sync", dest='nosync', action="store_true", help="don't sync the database when making a new one. only valid with --init")
+    ap.add_argument("--shards", type=int, default=0, metavar='N',
+                    help="spread the documents over N database files, which are synced and searched in parallel. only valid with --init")
 
     ap.add_argument("--sync", dest='sync', action="store_true", help="sync the fts database with the files on disk")
-    ap.add_argument("--optimize", action="store_true", help="optimize the sqlite database for size and performance")
+    ap.add_argument("--optimize", action="store_true", help="optimize the sqlite database for size and performance. This rewrites all of it, and nothing else can write to it until it's done")
+    ap.add_argument("--maintain", action="store_true",
+                    help="merge the index incrementally and release free space, for up to --max-seconds or --max-pages. Cheap enough to run after every sync")
+    ap.add_argument("--max-seconds", type=float, metavar='S',
+                    help="stop --maintain after about S seconds (default 1, 0 for no limit)")
+    ap.add_argument("--max-pages", type=int, metavar='N',
+                    help="stop --maintain after writing about N pages")
+    ap.add_argument("--automerge", type=int, choices=range(17), metavar='N',
+                    help="merge the index a little on every write once a level of it has N segments (2 to 16, 1 for the default of 8, 0 to turn it off)")
+
+    ap.add_argument("--watch", action="store_true",
+                    help="stay running and keep the database in sync as files change (uses inotify)")
+
+    ap.add_argument("--serve", action="store_true",
+                    help="stay running and answer searches for other fts processes, which saves them from opening the database themselves")
+    ap.add_argument("--cache-size", type=int, metavar='N',
+                    help="with --serve, remember the results of the last N searches until the database changes (default %d, 0 turns it off)" % CACHE_ENTRIES)
+    ap.add_argument("--no-server", dest='noserver', action="store_true",
+                    help="search in this process even if there's a --serve running")
+
+    ap.add_argument("--git", action="store_true",
+                    help="when syncing a git checkout, only sync the files that git says changed since the last --git sync (and sync everything the usual way if it can't say)")
+    ap.add_argument("--trust-dirs", dest='trust_dirs', action="store_true",
+                    help="when syncing, skip directories whose mtime hasn't changed since the last sync instead of checking every file in them. Faster, but it misses files that were modified in place")
+    # checking every file used to be optional
+    ap.add_argument("--strict", action="store_true", help=argparse.SUPPRESS)
+
+    ap.add_argument('-j', '--jobs', type=int, default=1, metavar='N',
+                    help="read files on N threads while syncing. Helps on network filesystems and cold caches")
+
+    ap.add_argument("--trigrams", choices=('on', 'off'),
+                    help="maintain a trigram index to speed up --re searches. It makes the database bigger and syncing slower")
+
+    ap.add_argument("--wal", choices=('on', 'off'),
+                    help="use a write-ahead log (the default), which lets searches run while a sync is writing. Turn it off for a database on a network filesystem, where it doesn't work")
+
+    ap.add_argument("--max-line-length", type=int, metavar='N',
+                    help="when syncing, skip files with lines longer than N bytes (e.g. minified code). 0 turns it off")
+    ap.add_argument("--max-entropy", type=float, metavar='BITS',
+                    help="when syncing, skip files whose first 8KiB has more than BITS bits of entropy per byte (e.g. compressed data). 0 turns it off")
+    ap.add_argument("--skipped", action='store_true',
+                    help="list the files that were skipped because they looked binary or generated, and roughly how much smaller that made the index")
 
     ap.add_argument('--sync-one', metavar='filename', help="sync a single file (unlike the other commands, this one doesn't care about the current directory)")
 
@@ -39,16 +93,110 @@ def main():
                     default='MATCH', action="store_const", const='REGEXP',
                     help="search using a regex instead of MATCH syntax. Much slower!")
 
+    ap.add_argument('--and', dest='combine', default='OR', action='store_const', const='AND',
+                    help="with more than one search, print only the files that match all of them")
+    ap.add_argument('--or', dest='combine', action='store_const', const='OR',
+                    help="with more than one search, print the files that match any of them (the default)")
+
+    ap.add_argument('--search-in', dest='search_in', metavar='dir', action='append', default=[],
+                    help="only search in this directory (or glob of directories) instead of the current one. Can be given more than once")
+
+    ap.add_argument('--federate', action='store_true',
+                    help="search every .fts.db that covers the current directory or is under it (and any --index), instead of just the nearest one")
+    ap.add_argument('--index', dest='indexes', metavar='dir', action='append', default=[],
+                    help="search the .fts.db in dir instead of the nearest one. may be given more than once or be a glob")
+    ap.add_argument('--limit', type=int, metavar='N',
+                    help="print only the best N results")
+    ap.add_argument('--offset', type=int, default=0, metavar='M',
+                    help="skip the best M results (e.g. to page through them with --limit)")
+
     ap.add_argument('-l', dest='display_mode', action='store_const', const='filename_only', help="print only the matching filenames")
+    ap.add_argument('-n', '--line-number', dest='line_numbers', action='store_true',
+                    help="print the matching lines with their line numbers instead of a snippet")
+    ap.add_argument('-A', '--after-context', dest='after', type=int, metavar='NUM',
+                    help="print the matching lines and NUM lines after them")
+    ap.add_argument('-B', '--before-context', dest='before', type=int, metavar='NUM',
+                    help="print the matching lines and NUM lines before them")
+    ap.add_argument('-C', '--context', dest='context', type=int, metavar='NUM',
+                    help="print the matching lines and NUM lines around them")
     ap.add_argument('--color-mode', dest='color_mode', choices=('yes', 'no', 'auto'), default='auto')
     ap.add_argument('--color', dest='color_mode', action='store_const', const='yes')
 
+    ap.add_argument('--stats', action='store_true',
+                    help="print how long each part of the work took and what it did to stderr when done")
+    ap.add_argument('--stats-format', choices=('text', 'json'),
+                    help="print --stats as text (the default) or JSON")
+
     ap.add_argument("search", nargs="*")
 
     args = ap.parse_args()
 
+    if args.watch and args.serve:
+        ap.error("--watch and --serve can't be used together")
+
+    if args.git and not (args.sync or (args.init and not args.nosync)):
+        ap.error("--git is only valid with --sync or --init")
+
+    federated = args.federate or args.indexes
+    if federated and (args.init or args.sync or args.sync_one or args.optimize or args.maintain
+                      or args.automerge is not None or args.watch
+                      or args.serve or args.trigrams or args.wal or args.rm_ignore or args.ignore_re
+                      or args.ignore_simple or args.ignore_glob or args.list_ignores
+                      or args.max_line_length is not None or args.max_entropy is not None
+                      or args.skipped):
+        ap.error("--federate and --index can only be used to search")
+    if federated and args.search_in:
+        ap.error("--search-in can't be used with --federate or --index")
+    if federated and not args.search:
+        ap.error("--federate and --index need something to search for")
+
+    if (args.max_seconds is not None or args.max_pages is not None) and not args.maintain:
+        ap.error("--max-seconds and --max-pages are only valid with --maintain")
+    if ((args.max_seconds is not None and args.max_seconds < 0)
+            or (args.max_pages is not None and args.max_pages < 0)):
+        ap.error("--max-seconds and --max-pages can't be negative")
+
+    if args.stats_format and not args.stats:
+        ap.error("--stats-format is only valid with --stats")
+
+    if args.cache_size is not None and not args.serve:
+        ap.error("--cache-size is only valid with --serve")
+    if args.cache_size is not None and args.cache_size < 0:
+        ap.error("--cache-size can't be negative")
+
+    if args.shards and not args.init:
+        ap.error("--shards is only valid with --init")
+    if args.shards < 0:
+        ap.error("--shards can't be negative")
+
+    if ((args.max_line_length is not None and args.max_line_length < 0)
+            or (args.max_entropy is not None and args.max_entropy < 0)):
+        ap.error("--max-line-length and --max-entropy can't be negative")
+
+    if (args.limit is not None and args.limit < 0) or args.offset < 0:
+        ap.error("--limit and --offset can't be negative")
+
+    # the search only has to work out what we're going to print
+    filenames_only = args.display_mode == 'filename_only'
+
+    # print lines instead of snippets?
+    context = None
+    if not filenames_only and (
+            args.line_numbers or args.after is not None or args.before is not None
+            or args.context is not None):
+        context = (args.before if args.before is not None else args.context or 0,
+                   args.after if args.after is not None else args.context or 0)
+        if min(context) < 0:
+            ap.error("-A, -B and -C can't be negative")
+
     logger.setLevel(getattr(logging, args.logging.upper()))
 
+    if args.stats:
+        # this has to be done before the database is opened, so that the
+        # functions that sqlite calls can be counted
+        stats.enable()
+        atexit.register(stats.report, args.stats_format or 'text')
+
     if args.color_mode == 'yes':
         color = True
     elif args.color_mode == 'no':
@@ -56,7 +204,7 @@ def main():
     else:
         # it's 'auto'
         color = (os.isatty(sys.stdout.fileno())
-                 and args.display_mode != 'filename_only'
+                 and not filenames_only
                  and args.searchmode != 'REGEXP' # since we don't have snippets working here yet
                  )
 
@@ -66,7 +214,7 @@ def main():
 
     if args.init:
         didsomething = True
-        init(cwd)
+        init(cwd, shards=args.shards, wal=args.wal != 'off')
 
     if args.sync_one:
         # this is designed to be called by tools like procmail or IDEs' on-save
@@ -88,12 +236,96 @@ def main():
         assert fpath.startswith(os.path.join(froot, fprefix))
 
         with conn:
-            sync(conn, froot, fprefix, files = [basename])
+            sync(conn, froot, fprefix, files = [basename], jobs = args.jobs)
 
         didsomething = True
 
 
-    root, prefix, conn = finddb(cwd)
+    def show(sr):
+        if filenames_only:
+            print sr.filename
+        else:
+            print sr.format(color=color, line_numbers=args.line_numbers)
+
+    if federated:
+        roots = find_indexes(cwd) if args.federate else []
+        for pattern in args.indexes:
+            dirs = glob.glob(os.path.join(cwd, pattern))
+            if not [d for d in dirs if is_index(d)]:
+                ap.error("--index %r doesn't have a %s in it" % (pattern, _db_name))
+            roots.extend(d for d in dirs if is_index(d))
+        if not roots:
+            ap.error("no indexes were found")
+
+        with stats.phase('search'):
+            for sr in federated_search(cwd, roots, args.search, args.searchmode,
+                                       combine=args.combine, color=color,
+                                       limit=args.limit, offset=args.offset,
+                                       context=context, filenames_only=filenames_only):
+                show(sr)
+                # at least one result was returned
+                exitval = 0
+        sys.exit(exitval)
+
+    root, prefix = findroot(cwd)
+
+    scopes = None
+    if args.search_in:
+        scopes = []
+        for pattern in args.search_in:
+            if glob.has_magic(pattern):
+                dirs = glob.glob(os.path.join(cwd, pattern))
+                if not dirs:
+                    ap.error("--search-in %r doesn't match anything" % (pattern,))
+            else:
+                dirs = [os.path.join(cwd, pattern)]
+            for d in dirs:
+                d = os.path.relpath(os.path.normpath(d), root)
+                if d == '..' or d.startswith('../'):
+                    ap.error("--search-in %r is outside of the database in %s" % (pattern, root))
+                scopes.append('' if d == '.' else d)
+
+    # searches can be answered by a running --serve instead, as long as we
+    # aren't going to change the database first
+    client = None
+    if args.search and not args.noserver and not args.stats and not (
+            args.init or args.sync or args.optimize or args.maintain or args.automerge is not None
+            or args.watch or args.serve or args.trigrams or args.wal
+            or args.rm_ignore or args.ignore_re or args.ignore_simple or args.ignore_glob
+            or args.max_line_length is not None or args.max_entropy is not None or args.skipped):
+        client = connect_client(root)
+
+    limit, offset = args.limit, args.offset
+    if client is not None:
+        shown = 0
+        try:
+            for sr in client.search(prefix, args.search, args.searchmode,
+                                    combine=args.combine, color=color, scopes=scopes,
+                                    limit=limit, offset=offset, context=context,
+                                    filenames_only=filenames_only):
+                show(sr)
+                shown += 1
+                # at least one result was returned
+                exitval = 0
+        except NoServer as e:
+            # carry on from where it left off. the results come in the same
+            # order either way
+            logger.warning("Lost the search server (%s), searching without it", e)
+            offset += shown
+            if limit is not None:
+                limit -= shown
+            client.close()
+        else:
+            client.close()
+            sys.exit(exitval)
+
+    conn = opendb(root)
+
+    if args.wal and not args.init:
+        # this can't be done in a transaction
+        didsomething = True
+        for db in with_shards(conn):
+            set_wal(db, args.wal == 'on')
 
     with conn:
         # all other top-level functions operate in one global transaction
@@ -116,6 +348,19 @@ def main():
             didsomething = True
             add_ignore(conn, 'glob', a)
 
+        if args.trigrams == 'on':
+            didsomething = True
+            for db in with_shards(conn):
+                enable_trigrams(db)
+        elif args.trigrams == 'off':
+            didsomething = True
+            for db in with_shards(conn):
+                disable_trigrams(db)
+
+        if args.max_line_length is not None or args.max_entropy is not None:
+            didsomething = True
+            set_limits(conn, args.max_line_length, args.max_entropy)
+
         if args.list_ignores:
             didsomething = True
             list_ignores(conn)
@@ -124,30 +369,60 @@ def main():
 
         if dosync:
             didsomething = True
-            sync(conn, root, prefix)
+            if args.git:
+                # this always syncs the whole database, since that's what
+                # the recorded state is for
+                git_sync(conn, root, jobs = args.jobs, trust_dirs = args.trust_dirs)
+            else:
+                sync(conn, root, prefix, jobs = args.jobs, trust_dirs = args.trust_dirs)
+
+        if args.skipped:
+            didsomething = True
+            skipped_report(conn)
+
+        if args.automerge is not None:
+            didsomething = True
+            set_automerge(conn, args.automerge)
 
         if args.optimize:
             didsomething = True
-            with Cursor(conn) as c:
-                logger.debug("OPTIMIZE")
-                c.execute("INSERT INTO files_fts(files_fts) values('optimize');")
-                logger.debug("VACUUM ANALYZE;")
-                c.execute("VACUUM ANALYZE;")
-
-        for term in args.search:
-            # for now, ANY search matching a document will return it, and it may be
-            # returned twice
+            with stats.phase('optimize'):
+                report(optimize(conn))
+        elif args.maintain:
             didsomething = True
+            seconds = args.max_seconds if args.max_seconds is not None else MAINTAIN_SECONDS
+            with stats.phase('maintain'):
+                report(maintain(conn, seconds=seconds or None, pages=args.max_pages))
 
-            for sr in search(conn, prefix, term, args.searchmode,
-                             checksync=dosync, color=color):
-                if args.display_mode == 'filename_only':
-                    print sr.filename
-                else:
-                    print sr.format(color=color)
+        if args.search:
+            didsomething = True
 
-                # at least one result was returned
-                exitval = 0
+            with stats.phase('search'):
+                for sr in search(conn, prefix, args.search, args.searchmode,
+                                 combine=args.combine, checksync=not dosync, color=color,
+                                 scopes=scopes, limit=limit, offset=offset,
+                                 context=context, filenames_only=filenames_only):
+                    show(sr)
+
+                    # at least one result was returned
+                    exitval = 0
+
+    if args.watch:
+        # this has to be outside of the global transaction, since it runs its
+        # own
+        didsomething = True
+        try:
+            watch(conn, root, prefix, jobs = args.jobs)
+        except KeyboardInterrupt:
+            pass
+
+    if args.serve:
+        didsomething = True
+        conn.close()
+        try:
+            serve(root, cache_size=args.cache_size if args.cache_size is not None else CACHE_ENTRIES)
+        except KeyboardInterrupt:
+            pass
 
     if not didsomething:
         ap.print_usage()
@@ -0,0 +1,287 @@
+#!/usr/bin/env python2.7
+
+"""
+benchmark fts against a synthetic corpus and report the results as JSON, so
+that runs can be compared across commits:
+
+    $ ./ftsbench.py --files 20000 > before.json
+
+the corpus is made from a seeded RNG and a built-in vocabulary, so the same
+arguments always make the same files. --init and the syncs are timed by
+running fts.py like a user would, and the searches are run in this process
+so that their latencies aren't swamped by python starting up
+"""
+
+import os
+import os.path
+import sys
+import json
+import time
+import random
+import shutil
+import sqlite3
+import logging
+import argparse
+import tempfile
+import subprocess
+
+from ftsdb import opendb, logger, _db_name, shard_names
+from ftsdb import re # re or re2
+from ftssearch import search
+from ftssync import RACY_WINDOW
+
+FTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fts.py')
+
+SYLLABLES = ['ba', 'ko', 'ri', 'tu', 'me', 'sa', 'lo', 'ne', 'vi', 'da',
+             'ge', 'pu', 'zo', 'fi', 'ha', 'mu', 'ra', 'te', 'ki', 'no',
+             'ju', 'se', 'wa', 'bo', 'li', 'chi', 'ster', 'mon', 'gal', 'ven']
+
+def vocabulary(rng, size):
+    """
+    size different made-up words, most common first
+    """
+    words = []
+    seen = set()
+    while len(words) < size:
+        word = ''.join(rng.choice(SYLLABLES) for x in xrange(rng.randint(2, 4)))
+        if word not in seen:
+            seen.add(word)
+            words.append(word)
+    return words
+
+def skewed(rng, words):
+    # a few words are very common and most are rare, like in real text
+    return words[int(len(words) * rng.random() ** 3)]
+
+def percentile(values, pct):
+    # nearest-rank
+    ordered = sorted(values)
+    return ordered[max(0, int(round(pct / 100.0 * len(ordered))) - 1)]
+
+class Corpus(object):
+    """
+    the synthetic files, spread over a tree of directories
+    """
+    def __init__(self, root, rng, words, args):
+        self.root = root
+        self.rng = rng
+        self.words = words
+        self.args = args
+        self.files = [] # the numbers of the files that exist
+        self.next = 0
+        self.bytes = 0
+
+    def path(self, n):
+        d = n % self.args.dirs
+        return os.path.join(self.root, 'd%02d' % (d % 10), 'd%03d' % d, 'f%06d.txt' % n)
+
+    def text(self):
+        lines = []
+        for x in xrange(self.rng.randint(self.args.min_lines, self.args.max_lines)):
+            lines.append(' '.join(skewed(self.rng, self.words)
+                                  for y in xrange(self.rng.randint(4, 14))))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, n):
+        # like an editor, write a new file and rename it into place, which
+        # changes the directory's mtime
+        fname = self.path(n)
+        dirname = os.path.dirname(fname)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        text = self.text()
+        with open(fname + '.tmp', 'w') as f:
+            f.write(text)
+        os.rename(fname + '.tmp', fname)
+        return len(text)
+
+    def create(self):
+        n = self.next
+        self.next += 1
+        self.files.append(n)
+        return self.write(n)
+
+    def populate(self, count):
+        for x in xrange(count):
+            self.bytes += self.create()
+
+    def churn(self, count):
+        """
+        update, delete and create count files each. returns how many bytes
+        were written
+        """
+        written = 0
+        for n in self.rng.sample(self.files, count):
+            written += self.write(n)
+        for n in self.rng.sample(self.files, count):
+            self.files.remove(n)
+            os.unlink(self.path(n))
+        for x in xrange(count):
+            written += self.create()
+        return written
+
+def settle():
+    # let the directories that we just changed age out of sync's racy
+    # window, so that the next sync can trust them like it would normally
+    time.sleep(RACY_WINDOW + 1)
+
+def run_fts(root, *args):
+    """
+    run fts.py in root and return how long it took
+    """
+    start = time.time()
+    subprocess.check_call([sys.executable, FTS, '--no-server'] + list(args), cwd=root)
+    return time.time() - start
+
+def db_bytes(root):
+    return sum(os.path.getsize(os.path.join(root, fname))
+               for fname in os.listdir(root)
+               if fname.startswith(_db_name))
+
+def indexed(root, shards=0):
+    dbfname = os.path.join(root, _db_name)
+    count = 0
+    for fname in [dbfname] + shard_names(dbfname, shards):
+        conn = sqlite3.connect(fname)
+        try:
+            count += conn.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+        finally:
+            conn.close()
+    return count
+
+def rate(count, seconds):
+    return round(count / seconds, 1) if seconds else None
+
+def time_searches(conn, queries, mode, combine='OR'):
+    latencies = []
+    hits = 0
+    for terms in queries:
+        start = time.time()
+        hits += sum(1 for sr in search(conn, '', terms, mode, combine=combine, checksync=False))
+        latencies.append(time.time() - start)
+    return dict(queries=len(queries),
+                mean_hits=round(float(hits) / len(queries), 1),
+                p50_ms=round(percentile(latencies, 50) * 1000, 2),
+                p95_ms=round(percentile(latencies, 95) * 1000, 2))
+
+def commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       cwd=os.path.dirname(FTS),
+                                       stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    ap = argparse.ArgumentParser('ftsbench', description="benchmark fts against a synthetic corpus")
+    ap.add_argument('--dir', help="make the corpus here instead of in a temporary directory. it must not exist yet")
+    ap.add_argument('--keep', action='store_true', help="don't delete the corpus afterwards")
+    ap.add_argument('--seed', type=int, default=0)
+    ap.add_argument('--files', type=int, default=5000)
+    ap.add_argument('--dirs', type=int, default=100)
+    ap.add_argument('--words', type=int, default=5000, help="the size of the vocabulary")
+    ap.add_argument('--min-lines', dest='min_lines', type=int, default=5)
+    ap.add_argument('--max-lines', dest='max_lines', type=int, default=60)
+    ap.add_argument('--small-churn', dest='small_churn', type=int, default=10,
+                    help="how many files to update, delete and create (each) before the small sync")
+    ap.add_argument('--large-churn', dest='large_churn', type=int, default=500,
+                    help="how many files to update, delete and create (each) before the large sync")
+    ap.add_argument('--searches', type=int, default=50, help="how many of each kind of search to run")
+    ap.add_argument('--terms', type=int, default=3, help="how many terms the multi-term searches have")
+    ap.add_argument('--trigrams', action='store_true', help="turn on the trigram index")
+    ap.add_argument('--shards', type=int, default=0, help="make a sharded index with this many shards")
+    ap.add_argument('-j', '--jobs', type=int, default=1)
+    ap.add_argument('-o', '--output', help="write the JSON here instead of to stdout")
+    args = ap.parse_args()
+
+    logger.setLevel(logging.WARN)
+
+    if args.large_churn * 2 > args.files or args.small_churn * 2 > args.files:
+        ap.error("there aren't enough files for that much churn")
+
+    rng = random.Random(args.seed)
+    words = vocabulary(rng, args.words)
+
+    if args.dir:
+        root = os.path.abspath(args.dir)
+        os.makedirs(root)
+    else:
+        root = tempfile.mkdtemp(prefix='ftsbench.')
+
+    def log(fmt, *a):
+        sys.stderr.write((fmt % a) + '\n')
+
+    results = dict(commit=commit(),
+                   python=sys.version.split()[0],
+                   sqlite=sqlite3.sqlite_version,
+                   params=vars(args))
+
+    try:
+        corpus = Corpus(root, rng, words, args)
+        corpus.populate(args.files)
+        results['corpus'] = dict(files=args.files, bytes=corpus.bytes)
+        log("made %d files (%.1fMB) in %s", args.files, corpus.bytes / 1e6, root)
+        settle()
+
+        init = ['--init', '--jobs', str(args.jobs)]
+        if args.trigrams:
+            init += ['--trigrams', 'on']
+        if args.shards:
+            init += ['--shards', str(args.shards)]
+        took = run_fts(root, *init)
+        results['init'] = dict(seconds=round(took, 3),
+                               files_per_sec=rate(args.files, took),
+                               mb_per_sec=rate(corpus.bytes / 1e6, took),
+                               indexed=indexed(root, args.shards))
+        results['db_bytes'] = db_bytes(root)
+        log("init: %.2fs", took)
+        settle()
+
+        took = run_fts(root, '--sync', '--jobs', str(args.jobs))
+        results['sync_noop'] = dict(seconds=round(took, 3),
+                                    files_per_sec=rate(args.files, took))
+        log("no-op sync: %.2fs", took)
+
+        for name, count in (('sync_small', args.small_churn), ('sync_large', args.large_churn)):
+            written = corpus.churn(count)
+            settle()
+            took = run_fts(root, '--sync', '--jobs', str(args.jobs))
+            results[name] = dict(seconds=round(took, 3),
+                                 changed=count * 3,
+                                 files_per_sec=rate(count * 3, took),
+                                 mb_per_sec=rate(written / 1e6, took),
+                                 indexed=indexed(root, args.shards))
+            log("%s: %.2fs", name.replace('_', ' '), took)
+
+        results['db_bytes_after_churn'] = db_bytes(root)
+
+        # searches for words that are in the corpus, in the same proportions
+        singles = [[skewed(rng, words)] for x in xrange(args.searches)]
+        multis = [[skewed(rng, words) for y in xrange(args.terms)] for x in xrange(args.searches)]
+        # the middle of the word can be anything
+        regexes = [[re.escape(w[:2]) + '[a-z]+' + re.escape(w[-2:])] for [w] in singles]
+
+        conn = opendb(root)
+        try:
+            results['search'] = dict(
+                match=time_searches(conn, singles, 'MATCH'),
+                match_or=time_searches(conn, multis, 'MATCH', 'OR'),
+                match_and=time_searches(conn, multis, 'MATCH', 'AND'),
+                regexp=time_searches(conn, regexes, 'REGEXP'),
+                regexp_or=time_searches(conn, multis, 'REGEXP', 'OR'),
+            )
+        finally:
+            conn.close()
+        for name, r in sorted(results['search'].iteritems()):
+            log("%s searches: p50 %.1fms, p95 %.1fms", name, r['p50_ms'], r['p95_ms'])
+
+    finally:
+        if not args.keep:
+            shutil.rmtree(root)
+
+    out = open(args.output, 'w') if args.output else sys.stdout
+    json.dump(results, out, indent=2, sort_keys=True)
+    out.write('\n')
+
+if __name__ == '__main__':
+    main()
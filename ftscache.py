@@ -0,0 +1,79 @@
+"""
+a cache of search results for a process that answers lots of searches
+against the same database, like the search server.
+
+results are kept for as long as the database's generation (and those of its
+shards) stays the same. every change to the documents bumps it, so checking
+whether everything that's cached is still good is a read of the config
+table in each database, however many results there are. only the most
+recently used searches are kept
+"""
+
+from collections import OrderedDict
+
+from ftsdb import Cursor, openfile, shard_files, generation
+from ftsstats import stats
+
+# how many searches to remember, and how many results between them
+CACHE_ENTRIES = 256
+CACHE_RESULTS = 20000
+
+class ResultCache(object):
+    def __init__(self, conn, entries=CACHE_ENTRIES, results=CACHE_RESULTS, check_same_thread=True):
+        self.conn = conn
+        self.max_entries = entries
+        self.max_results = results
+        self.entries = OrderedDict() # key -> [SearchResult], least recently used first
+        self.results = 0
+        self.generation = None
+
+        # we need the shards' generations too, since their documents are
+        # written to them directly
+        with Cursor(conn) as c:
+            self.shards = [openfile(fname, check_same_thread=check_same_thread)
+                           for fname in shard_files(c)]
+
+    def current(self):
+        gens = []
+        for db in [self.conn] + self.shards:
+            with Cursor(db) as c:
+                gens.append(generation(c))
+        return tuple(gens)
+
+    def clear(self):
+        self.entries.clear()
+        self.results = 0
+
+    def search(self, key, search):
+        """
+        the results for key, which has to include everything about the search
+        that changes them. if they aren't cached, they're the list of what
+        search() returns
+        """
+        # read before searching, so that if the database changes while we do
+        # the results are thrown away next time instead of being kept
+        gen = self.current()
+        if gen != self.generation:
+            self.clear()
+            self.generation = gen
+
+        if key in self.entries:
+            stats.count('cache hits')
+            results = self.entries.pop(key)
+            self.entries[key] = results
+            return results
+
+        stats.count('cache misses')
+        results = list(search())
+        if self.max_entries and len(results) <= self.max_results:
+            self.entries[key] = results
+            self.results += len(results)
+            while len(self.entries) > self.max_entries or self.results > self.max_results:
+                old, evicted = self.entries.popitem(last=False)
+                self.results -= len(evicted)
+        return results
+
+    def close(self):
+        self.clear()
+        for db in self.shards:
+            db.close()
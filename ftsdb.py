@@ -1,15 +1,36 @@
 import sqlite3
 import os.path
 import logging
-import struct
+import math
+import array
+import time
+import zlib
+import urllib
 from functools import wraps
+from contextlib import contextmanager
 
 try:
     import re2 as re
 except ImportError:
     import re
 
+from ftsstats import stats
+
 _db_name = '.fts.db'
+_sock_name = '.fts.sock'
+
+# bump this and add a step to upgradeschema whenever the schema changes
+SCHEMA_VERSION = 9
+
+# the fts4 tables, for things that have to be done to all of them
+FTS_TABLES = ('files_fts', 'files_trigrams')
+
+# the page cache to use while bulk loading, in KiB
+BULK_CACHE_SIZE = 64*1024
+
+# how many directories prefix_clauses puts in each statement. each takes up
+# to three parameters
+PREFIX_CHUNK = 300
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger("fts")
@@ -35,20 +56,27 @@ def createschema(c):
     c.execute("INSERT INTO exclusions(type, expression) VALUES('glob', '*~')")
     c.execute("INSERT INTO exclusions(type, expression) VALUES('glob', '*.o')")
     c.execute("INSERT INTO exclusions(type, expression) VALUES('simple', ?)", (_db_name,))
+    c.execute("INSERT INTO exclusions(type, expression) VALUES('glob', ?)", (_db_name + '-*',))
+    c.execute("INSERT INTO exclusions(type, expression) VALUES('simple', ?)", (_sock_name,))
     c.execute("INSERT INTO exclusions(type, expression) VALUES('simple', '.svn')")
     c.execute("INSERT INTO exclusions(type, expression) VALUES('simple', '.git')")
     c.execute("INSERT INTO exclusions(type, expression) VALUES('simple', '.hg')")
 
-    # docid references the files_fts
+    # docid references the files_fts. hash is the hex sha1 of the indexed
+    # contents
     c.execute("""
         CREATE TABLE IF NOT EXISTS
         files (
             docid         INTEGER PRIMARY KEY AUTOINCREMENT,
             path          NOT NULL COLLATE BINARY,
-            last_modified INTEGER NOT NULL
+            last_modified INTEGER NOT NULL,
+            hash          TEXT COLLATE BINARY
         );
     """)
-    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS files_path_idx ON files(path);")
+    create_path_index(c)
+    c.execute("CREATE INDEX IF NOT EXISTS files_hash_idx ON files(hash);")
+
+    create_dirs_table(c)
 
     # normally we'd use "IF NOT EXISTS" but fts4 doesn't support it
     if not c.execute("SELECT DISTINCT tbl_name FROM sqlite_master WHERE tbl_name = 'files_fts'").fetchall():
@@ -60,6 +88,150 @@ def createschema(c):
             );
         """)
 
+    create_trigrams_table(c)
+    create_lines_table(c)
+    create_segments_table(c)
+    create_skipped_table(c)
+    setconfig(c, 'generation', 0)
+
+    setconfig(c, 'schema_version', SCHEMA_VERSION)
+
+def upgradeschema(c):
+    """
+    bring a database created by an older version up to date. returns the
+    version that it was
+    """
+    version = getconfig(c, 'schema_version', 0)
+    if version == SCHEMA_VERSION:
+        return version
+
+    logger.info("Upgrading schema from version %d to %d", version, SCHEMA_VERSION)
+
+    if version < 1:
+        # documents indexed before this will be reindexed the next time they
+        # change, since we don't know their hash
+        c.execute("ALTER TABLE files ADD COLUMN hash TEXT COLLATE BINARY;")
+        c.execute("CREATE INDEX IF NOT EXISTS files_hash_idx ON files(hash);")
+
+    if version < 2:
+        create_dirs_table(c)
+
+    if version < 3:
+        # the search server's socket lives next to the database
+        c.execute("INSERT INTO exclusions(type, expression) VALUES('simple', ?)", (_sock_name,))
+
+    if version < 4:
+        create_trigrams_table(c)
+
+    if version < 5:
+        create_lines_table(c)
+
+        from ftslines import line_starts
+        count = 0
+        for docid, body in c.conn.execute("SELECT docid, body FROM files_fts"):
+            c.execute("INSERT INTO lines(docid, starts) VALUES(?, ?)",
+                      (docid, line_starts(body or '')))
+            count += 1
+        logger.info("Built line tables for %d documents", count)
+
+    if version < 6:
+        # the write-ahead log and its index (and the rollback journal before
+        # that)
+        c.execute("INSERT INTO exclusions(type, expression) VALUES('glob', ?)", (_db_name + '-*',))
+
+    if version < 7:
+        create_segments_table(c)
+
+        # files used to be cut off after the first MiB. the ones that may have
+        # been have to be read again, and so do the directories that they're
+        # in or the next sync will skip them
+        c.execute("""
+            UPDATE files SET last_modified = 0
+             WHERE docid IN (SELECT docid FROM files_fts
+                              WHERE length(CAST(body AS BLOB)) >= 1024*1024)
+        """)
+        logger.info("Marked %d truncated documents for reindexing", c.rowcount)
+        c.execute("""
+            UPDATE dirs SET last_modified = NULL
+             WHERE path IN (SELECT rtrim(rtrim(path, replace(path, '/', '')), '/')
+                              FROM files WHERE last_modified = 0)
+        """)
+
+    if version < 8:
+        create_skipped_table(c)
+
+    if version < 9:
+        setconfig(c, 'generation', 0)
+
+    setconfig(c, 'schema_version', SCHEMA_VERSION)
+    return version
+
+def create_dirs_table(c):
+    # the directories that we saw on the last sync, so that we don't have to
+    # walk them again if they haven't changed. path is relative to the root
+    # like files.path ('' for the root itself). last_modified is NULL if it
+    # can't be trusted
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS
+        dirs (
+            path          TEXT PRIMARY KEY COLLATE BINARY,
+            parent        TEXT COLLATE BINARY,
+            last_modified REAL,
+            inode         INTEGER
+        );
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS dirs_parent_idx ON dirs(parent);")
+
+def create_trigrams_table(c):
+    # see ftstrigrams. it's empty unless they're turned on
+    if not c.execute("SELECT DISTINCT tbl_name FROM sqlite_master WHERE tbl_name = 'files_trigrams'").fetchall():
+        c.execute("""
+            CREATE VIRTUAL TABLE
+            files_trigrams USING fts4 (
+                grams TEXT COLLATE BINARY NOT NULL
+            );
+        """)
+
+def create_lines_table(c):
+    # see ftslines. starts is the packed offsets of the lines in the document
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS
+        lines (
+            docid  INTEGER PRIMARY KEY,
+            starts BLOB NOT NULL
+        );
+    """)
+
+def create_segments_table(c):
+    # see ftssegments. a document that's been split up has a row here for
+    # each of its segments, whose segid is its docid in files_fts. hash is the
+    # hex sha1 of the segment's contents
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS
+        segments (
+            segid INTEGER PRIMARY KEY,
+            docid INTEGER NOT NULL,
+            start INTEGER NOT NULL,
+            hash  TEXT COLLATE BINARY
+        );
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS segments_docid_idx ON segments(docid, start);")
+
+def create_skipped_table(c):
+    # see ftssniff. the documents that were left out of files_fts, why, and
+    # how big they were
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS
+        skipped (
+            docid  INTEGER PRIMARY KEY,
+            reason TEXT NOT NULL,
+            size   INTEGER NOT NULL
+        );
+    """)
+
+def create_path_index(c):
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS files_path_idx ON files(path);")
+
 def getconfig(c, key, default=None):
     c.execute("SELECT value FROM config WHERE key= ? ", (key,))
     vals = list(c.fetchall())
@@ -79,6 +251,15 @@ def setconfig(c, key, value):
     c.execute("UPDATE config SET value = ? WHERE key = ?", (value, key))
     return oldval
 
+def generation(c):
+    # bumped by every change to the documents, so that anything that's
+    # derived from them (like ftscache's results) can tell when it's out of
+    # date
+    return getconfig(c, 'generation', 0)
+
+def bump_generation(c):
+    c.execute("UPDATE config SET value = value + 1 WHERE key = 'generation'")
+
 def log_errors(fn):
     # sqlite swallows exceptions before reraising its own, so we'll add our own
     # logging
@@ -96,43 +277,199 @@ def regexp(expr, item):
     item = item or ''
     return re.search(expr, item) is not None
 
-def make_rank_func(weights):
-    """
-    Taken from http://chipaca.com/post/16877190061/doing-full-text-search-in-sqlite-from-python
-    """
-    @log_errors
-    def rank(matchinfo):
-        # matchinfo is defined as returning 32-bit unsigned integers
-        # in machine byte order
-        # http://www.sqlite.org/fts3.html#matchinfo
-        # and struct defaults to machine byte order
-        matchinfo = struct.unpack("I"*(len(matchinfo)/4), matchinfo)
-        it = iter(matchinfo[2:])
-        return sum(x[0]*w/x[1]
-                   for x, w in zip(zip(it, it, it), weights)
-                   if x[1])
-    return rank
-
-def connect(fname):
-    conn = sqlite3.connect(fname)
+# these take several regexes at once so that the document only has to be
+# handed over to Python once
+
+@log_errors
+def regexp_any(item, *exprs):
+    item = item or ''
+    return any(re.search(expr, item) is not None for expr in exprs)
+
+@log_errors
+def regexp_all(item, *exprs):
+    item = item or ''
+    return all(re.search(expr, item) is not None for expr in exprs)
+
+@log_errors
+def regexp_mask(item, *exprs):
+    """
+    a bitmask of which of the regexes match
+    """
+    item = item or ''
+    return sum(1 << x for x, expr in enumerate(exprs)
+               if re.search(expr, item) is not None)
+
+class BitOr(object):
+    """
+    an aggregate for OR-ing together regexp_masks
+    """
+    def __init__(self):
+        self.value = 0
+
+    def step(self, value):
+        self.value |= value or 0
+
+    def finalize(self):
+        return self.value
+
+# bm25 tuning parameters. k1 is how quickly repeated hits stop counting for
+# more and b is how much a document's length counts against it
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+def unpack_matchinfo(matchinfo):
+    # matchinfo is defined as returning 32-bit unsigned integers in machine
+    # byte order http://www.sqlite.org/fts3.html#matchinfo. array unpacks
+    # them in one go
+    mi = array.array('I')
+    mi.fromstring(str(matchinfo))
+    return mi
+
+def varints(blob):
+    # the integers in one of fts4's records
+    nums = []
+    n = shift = 0
+    for ch in str(blob):
+        b = ord(ch)
+        n |= (b & 0x7f) << shift
+        shift += 7
+        if not b & 0x80:
+            nums.append(n)
+            n = shift = 0
+    return nums
+
+@log_errors
+def bm25(matchinfo, *weights):
+    """
+    Okapi BM25 over matchinfo(files_fts, 'pcnalx'), with one optional weight
+    per column (defaulting to 1.0). Bigger is better
+    """
+    return _bm25(unpack_matchinfo(matchinfo), weights)
+
+@log_errors
+def bm25_corpus(matchinfo, corpus, *weights):
+    """
+    bm25, but with the number of rows, the average column lengths and the
+    rows with hits taken from corpus (a matchinfo with the same layout, see
+    ftssearch.combine_corpus) instead of from this table. ranks from several
+    databases can be compared if they're all given the same corpus
+    """
+    mi = unpack_matchinfo(matchinfo)
+    if corpus is not None:
+        co = unpack_matchinfo(corpus)
+        ncols = mi[1]
+        mi[2] = co[2]
+        mi[3:3+ncols] = co[3:3+ncols]
+        for x in xrange(3+2*ncols+2, len(mi), 3):
+            mi[x] = co[x]
+    return _bm25(mi, weights)
+
+def _bm25(mi, weights):
+    ncols, nrows = mi[1], mi[2]
+    log = math.log
+
+    score = 0.0
+    for col in xrange(ncols):
+        w = weights[col] if col < len(weights) else 1.0
+        if not w:
+            continue
+
+        # mi[3+col] is the average length of the column and mi[3+ncols+col]
+        # is its length in this row
+        norm = BM25_K1 * (1 - BM25_B + BM25_B * mi[3+ncols+col] / float(mi[3+col] or 1))
+
+        # then for each phrase, (hits in this row, hits in all rows, rows
+        # with hits)
+        for x in xrange(3+2*ncols+3*col, len(mi), 3*ncols):
+            tf = mi[x]
+            if tf:
+                docs = mi[x+2]
+                # the +1 keeps words that are in most documents from scoring
+                # below zero
+                idf = log(1 + (nrows - docs + 0.5) / (docs + 0.5))
+                score += w * idf * tf * (BM25_K1 + 1) / (tf + norm)
+
+    return score
+
+def connect(fname, check_same_thread=True):
+    conn = sqlite3.connect(fname, check_same_thread=check_same_thread)
     conn.text_factory=str
     conn.isolation_level = 'EXCLUSIVE'
 
-    # we only use LIKE for prefix matches on filenames. Some OSs have case-
-    # insensitive filesystems, but sorry guys
-    conn.execute('PRAGMA case_sensitive_like=ON;')
+    if not fname.startswith('file:') and not _writable(fname):
+        # sqlite can't read a WAL database unless it can make (or there
+        # already is) the -shm file next to it, which it can't on a read-only
+        # mount or in a directory that we can't write to. if there's no -shm
+        # file then nothing has the database open to write to it, so we can
+        # read the file as it is
+        try:
+            conn.execute("SELECT COUNT(*) FROM sqlite_master;").fetchone()
+        except sqlite3.OperationalError as e:
+            logger.debug("Opening %s immutable: %s", fname, e)
+            conn.close()
+            return connect('file:%s?immutable=1' % urllib.quote(os.path.abspath(fname)),
+                           check_same_thread=check_same_thread)
+
+    _set_synchronous(conn, conn.execute('PRAGMA journal_mode;').fetchone()[0])
+
+    # install our regex engine and ranking function. they're called for every
+    # row, so they're only wrapped to be counted if we're asked to
+    for name, nargs, fn in (("REGEXP", 2, regexp),
+                            ("regexp_any", -1, regexp_any),
+                            ("regexp_all", -1, regexp_all),
+                            ("regexp_mask", -1, regexp_mask),
+                            ("bm25", -1, bm25),
+                            ("bm25_corpus", -1, bm25_corpus)):
+        if stats.enabled:
+            fn = stats.counted(name, fn)
+        conn.create_function(name, nargs, fn)
+    conn.create_aggregate("bit_or", 1, BitOr)
 
-    # install our regex engine
-    conn.create_function("REGEXP", 2, regexp)
+    return conn
 
-    conn.create_function("simple_rank", 1, make_rank_func((1.0,)))
+def _set_synchronous(conn, journal_mode):
+    # NORMAL is safe with a write-ahead log (see set_wal), it just doesn't
+    # sync on every commit. with the rollback journal it can corrupt the
+    # database on a power failure, so that keeps sqlite's FULL. it's per
+    # connection, so it's set on every one
+    if journal_mode.lower() == 'wal':
+        conn.execute('PRAGMA synchronous=NORMAL;')
+    else:
+        conn.execute('PRAGMA synchronous=FULL;')
 
-    return conn
+def _writable(fname):
+    dirname = os.path.dirname(os.path.abspath(fname))
+    return (os.access(dirname, os.W_OK)
+            and (not os.path.exists(fname) or os.access(fname, os.W_OK)))
+
+def set_auto_vacuum(conn):
+    # so that ftsoptimize.maintain can give free pages back. it only takes
+    # effect on a database that has no tables yet (and hasn't been switched
+    # to WAL) or on its next VACUUM
+    conn.execute('PRAGMA auto_vacuum=INCREMENTAL;')
+
+def set_wal(conn, on=True):
+    """
+    switch the database to a write-ahead log, so that searches can read the
+    last committed state of the database while a sync is writing to it, or
+    (with on=False) back to sqlite's rollback journal, for databases on
+    network filesystems where WAL doesn't work. the mode is stored in the
+    database file, so this only has to be done once
+    """
+    mode = 'wal' if on else 'delete'
+    got = conn.execute('PRAGMA journal_mode=%s;' % mode).fetchone()[0]
+    if got.lower() != mode:
+        logger.warning("Couldn't switch the journal mode to %s, it's still %s", mode, got)
+    _set_synchronous(conn, got)
 
 class NoDB(Exception):
     pass
 
-def finddb(initroot, root = None):
+def findroot(initroot, root = None):
+    """
+    find the directory containing the .fts.db that covers initroot, without
+    opening it. returns (root, prefix)
+    """
     # 'root' must be an absolute path
     if root is None:
         root = initroot
@@ -144,9 +481,8 @@ def finddb(initroot, root = None):
     if os.path.exists(dbfname):
         assert initroot.startswith(root)
 
-        conn = connect(dbfname)
         prefix = initroot[len(root)+1:]
-        return root, prefix, conn
+        return root, prefix
 
     if root in ('/', ''):
         raise NoDB()
@@ -156,37 +492,381 @@ def finddb(initroot, root = None):
     components = os.path.split(root)
     parents, wd = components[:-1], components[-1]
     parent = os.path.join(*parents)
-    return finddb(initroot, parent)
+    return findroot(initroot, parent)
+
+def opendb(root, **kw):
+    return openfile(os.path.join(root, _db_name), **kw)
+
+def openfile(fname, **kw):
+    conn = connect(fname, **kw)
+    with conn, Cursor(conn) as c:
+        version = upgradeschema(c)
+    if version < 6:
+        # it has to be done outside of a transaction
+        set_wal(conn)
+    return conn
+
+def finddb(initroot, root = None):
+    # 'root' must be an absolute path
+    root, prefix = findroot(initroot, root)
+    return root, prefix, opendb(root)
 
-def createdb(root):
+def createdb(root, shards=0, wal=True):
     # 'root' must be an absolute path
     dbfname = os.path.join(root, _db_name)
     conn = connect(dbfname)
-    with Cursor(conn) as c:
+    set_auto_vacuum(conn)
+    set_wal(conn, wal)
+    with conn, Cursor(conn) as c:
         createschema(c)
+        if shards:
+            setconfig(c, 'shards', shards)
+
+    # each shard is an ordinary database holding some of the documents. only
+    # the main one's config, exclusions and dirs are used
+    for fname in shard_names(dbfname, shards):
+        sconn = connect(fname)
+        set_auto_vacuum(sconn)
+        set_wal(sconn, wal)
+        with sconn, Cursor(sconn) as c:
+            createschema(c)
+        sconn.close()
+
     return dbfname, conn
 
-def prefix_expr(prefix):
-    prefixexpr = prefix.replace('\\', '\\\\').replace('%', '\\%',).replace('_', '\\_') + '/%'
-    return prefixexpr
+def shard_names(dbfname, shards):
+    # next to the database, where the .fts.db-* exclusion keeps them out of
+    # the index
+    return ['%s-shard%d' % (dbfname, x) for x in xrange(shards)]
 
-def add_document(c, fname, last_modified, content):
-    c.execute("INSERT INTO files(docid, path, last_modified) VALUES(NULL, ?, ?)",
-               (fname, last_modified))
-    docid = c.lastrowid
+def shard_files(c):
+    """
+    the filenames of the shards that hold the documents of the database that c
+    is connected to, or an empty list if it holds them itself
+    """
+    shards = getconfig(c, 'shards', 0)
+    if not shards:
+        return []
+    c.execute("PRAGMA database_list")
+    dbfname = [fname for seq, name, fname in c.fetchall() if name == 'main'][0]
+    return shard_names(dbfname, shards)
+
+def shard_of(path, shards):
+    # documents are spread over the shards by a hash of their path. it has to
+    # be the same in every process, which python's hash() isn't
+    return (zlib.crc32(path) & 0xffffffff) % shards
+
+def with_shards(conn):
+    """
+    yield conn and then a connection to each of its shards, for things that
+    have to be done to all of the documents. the shards' are committed and
+    closed as we go
+    """
+    yield conn
+    with Cursor(conn) as c:
+        fnames = shard_files(c)
+    for fname in fnames:
+        sconn = openfile(fname)
+        try:
+            with sconn:
+                yield sconn
+        finally:
+            sconn.close()
+
+def prefix_range(prefix):
+    """
+    paths under the directory prefix are the ones with lo <= path < hi. '0'
+    is the character after '/'. unlike LIKE, this can use an index
+    """
+    return prefix + '/', prefix + '0'
+
+def prefix_clause(column, prefixes, name='scope', include_self=False):
+    """
+    an SQL expression and its named parameters for column being under any of
+    the directories in prefixes (or, with include_self, being one of them)
+    """
+    if '' in prefixes:
+        # the whole database
+        return '1', {}
+
+    clauses = []
+    params = {}
+    for x, prefix in enumerate(prefixes):
+        lo, hi = prefix_range(prefix)
+        keys = dict(column=column, self='%s%d' % (name, x),
+                    lo='%s%d_lo' % (name, x), hi='%s%d_hi' % (name, x))
+        clause = '(%(column)s >= :%(lo)s AND %(column)s < :%(hi)s)' % keys
+        if include_self:
+            clause = '%(column)s = :%(self)s OR ' % keys + clause
+            params[keys['self']] = prefix
+        clauses.append(clause)
+        params[keys['lo']] = lo
+        params[keys['hi']] = hi
+
+    return '(%s)' % ' OR '.join(clauses), params
+
+def prefix_clauses(column, prefixes, name='scope', include_self=False):
+    """
+    prefix_clause for PREFIX_CHUNK of the prefixes at a time, for statements
+    that can be run once per chunk, since sqlite before 3.32 only allows 999
+    parameters in a statement
+    """
+    for x in xrange(0, len(prefixes), PREFIX_CHUNK):
+        yield prefix_clause(column, prefixes[x:x+PREFIX_CHUNK], name, include_self)
+
+def _insert_body(c, docid, content, trigrams=None, lines=None):
+    # the indexed copy of a document (or a segment of one)
     c.execute("INSERT INTO files_fts(docid, body) VALUES(?, ?)",
                (docid, content))
+    if trigrams is not None:
+        c.execute("INSERT INTO files_trigrams(docid, grams) VALUES(?, ?)",
+                   (docid, trigrams))
+    if lines is not None:
+        c.execute("INSERT INTO lines(docid, starts) VALUES(?, ?)",
+                   (docid, lines))
+
+def _update_body(c, docid, content, trigrams=None, lines=None):
+    c.execute("UPDATE files_fts SET body=? WHERE docid=?",
+               (content, docid))
+    c.execute("DELETE FROM files_trigrams WHERE docid=?", (docid,))
+    if trigrams is not None:
+        c.execute("INSERT INTO files_trigrams(docid, grams) VALUES(?, ?)",
+                   (docid, trigrams))
+    c.execute("DELETE FROM lines WHERE docid=?", (docid,))
+    if lines is not None:
+        c.execute("INSERT INTO lines(docid, starts) VALUES(?, ?)",
+                   (docid, lines))
+
+def _delete_body(c, docid):
+    c.execute("DELETE FROM files_fts WHERE docid=?", (docid,))
+    c.execute("DELETE FROM files_trigrams WHERE docid=?", (docid,))
+    c.execute("DELETE FROM lines WHERE docid=?", (docid,))
+
+def _next_segid(c):
+    # segments after the first get negative docids in files_fts
+    c.execute("SELECT MIN(segid) FROM segments")
+    return min(c.fetchone()[0] or 0, 0) - 1
+
+def _add_body(c, docid, content, trigrams=None, lines=None, segments=None):
+    _insert_body(c, docid, content, trigrams, lines)
+
+    if segments is not None:
+        c.execute("INSERT INTO segments(segid, docid, start, hash) VALUES(?, ?, ?, ?)",
+                  (docid, docid, 0, segments[0].digest))
+        for seg in segments[1:]:
+            segid = _next_segid(c)
+            c.execute("INSERT INTO segments(segid, docid, start, hash) VALUES(?, ?, ?, ?)",
+                      (segid, docid, seg.start, seg.digest))
+            _insert_body(c, segid, seg.content, seg.trigrams, seg.lines)
+
+def add_document(c, fname, last_modified, content, digest=None, trigrams=None, lines=None,
+                 segments=None):
+    """
+    add a document. if it's been split into segments (a list of objects with
+    start, content, digest, trigrams and lines), content, trigrams and lines
+    are the first one's
+    """
+    bump_generation(c)
+    c.execute("INSERT INTO files(docid, path, last_modified, hash) VALUES(NULL, ?, ?, ?)",
+               (fname, last_modified, digest))
+    docid = c.lastrowid
+    _add_body(c, docid, content, trigrams, lines, segments)
     return docid
 
+def add_skipped(c, fname, last_modified, digest, reason, size):
+    # a document that ftssniff says to leave out of the index
+    bump_generation(c)
+    c.execute("INSERT INTO files(docid, path, last_modified, hash) VALUES(NULL, ?, ?, ?)",
+               (fname, last_modified, digest))
+    docid = c.lastrowid
+    c.execute("INSERT INTO skipped(docid, reason, size) VALUES(?, ?, ?)",
+               (docid, reason, size))
+    return docid
+
+def add_documents(c, docs):
+    """
+    add many documents at once. docs is a list of (fname, last_modified,
+    content, digest, trigrams, lines)
+    """
+    bump_generation(c)
+    # we have to pick the docids ourselves to be able to batch the inserts into
+    # both tables. files is AUTOINCREMENT so never reuse one that's been handed
+    # out before, even if that document has since been deleted
+    c.execute("""
+        SELECT MAX(COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'files'), 0),
+                   COALESCE((SELECT MAX(docid) FROM files), 0))
+    """)
+    first = c.fetchone()[0] + 1
+
+    c.executemany("INSERT INTO files(docid, path, last_modified, hash) VALUES(?, ?, ?, ?)",
+                  ((first+i, fname, last_modified, digest)
+                   for i, (fname, last_modified, content, digest, trigrams, lines) in enumerate(docs)))
+    c.executemany("INSERT INTO files_fts(docid, body) VALUES(?, ?)",
+                  ((first+i, content)
+                   for i, (fname, last_modified, content, digest, trigrams, lines) in enumerate(docs)))
+    c.executemany("INSERT INTO files_trigrams(docid, grams) VALUES(?, ?)",
+                  ((first+i, trigrams)
+                   for i, (fname, last_modified, content, digest, trigrams, lines) in enumerate(docs)
+                   if trigrams is not None))
+    c.executemany("INSERT INTO lines(docid, starts) VALUES(?, ?)",
+                  ((first+i, lines)
+                   for i, (fname, last_modified, content, digest, trigrams, lines) in enumerate(docs)
+                   if lines is not None))
+
 def remove_document(c, docid):
+    bump_generation(c)
+    c.execute("SELECT segid FROM segments WHERE docid=? AND segid != docid", (docid,))
+    for segid, in c.fetchall():
+        _delete_body(c, segid)
+    c.execute("DELETE FROM segments WHERE docid=?", (docid,))
+    c.execute("DELETE FROM skipped WHERE docid=?", (docid,))
     c.execute("DELETE FROM files WHERE docid=?", (docid,))
-    c.execute("DELETE FROM files_fts WHERE docid=?", (docid,))
-
-def update_document(c, docid, last_modified, content):
+    _delete_body(c, docid)
+
+def skip_document(c, docid, last_modified, digest, reason, size):
+    # for when a document has changed into one that ftssniff says to leave out
+    # of the index
+    bump_generation(c)
+    c.execute("UPDATE files SET last_modified=?, hash=? WHERE docid=?",
+               (last_modified, digest, docid))
+    c.execute("SELECT segid FROM segments WHERE docid=? AND segid != docid", (docid,))
+    for segid, in c.fetchall():
+        _delete_body(c, segid)
+    c.execute("DELETE FROM segments WHERE docid=?", (docid,))
+    _delete_body(c, docid)
+    c.execute("INSERT OR REPLACE INTO skipped(docid, reason, size) VALUES(?, ?, ?)",
+               (docid, reason, size))
+
+def update_document(c, docid, last_modified, content, digest=None, trigrams=None, lines=None,
+                    segments=None):
+    """
+    replace a document's contents. as with add_document, content, trigrams
+    and lines are the first segment's if it's been split into segments, and
+    then only the segments that changed are indexed again
+    """
+    bump_generation(c)
+    c.execute("UPDATE files SET last_modified=?, hash=? WHERE docid=?",
+               (last_modified, digest, docid))
+
+    c.execute("DELETE FROM skipped WHERE docid=?", (docid,))
+    if c.rowcount:
+        # it was skipped before, so there's nothing to replace
+        _add_body(c, docid, content, trigrams, lines, segments)
+        return
+
+    c.execute("SELECT segid, start, hash FROM segments WHERE docid=? ORDER BY start", (docid,))
+    old = c.fetchall()
+
+    if segments is None:
+        for segid, start, hash in old:
+            if segid != docid:
+                _delete_body(c, segid)
+        c.execute("DELETE FROM segments WHERE docid=?", (docid,))
+        _update_body(c, docid, content, trigrams, lines)
+        return
+
+    if not old:
+        # it used to be small enough to be indexed in one piece
+        old = [(docid, 0, None)]
+    oldlast = old[-1][0]
+
+    # the first segment is always the document's own row. the others are
+    # matched up with old ones that have the same contents, which may have
+    # moved if something before them changed size
+    reuse = {} # hash -> [segid]
+    for segid, start, hash in old:
+        if segid != docid:
+            reuse.setdefault(hash, []).append(segid)
+    keep = {} # index into segments -> old segid
+    for x, seg in enumerate(segments[1:], 1):
+        if reuse.get(seg.digest):
+            keep[x] = reuse[seg.digest].pop(0)
+    for segids in reuse.itervalues():
+        for segid in segids:
+            _delete_body(c, segid)
+            c.execute("DELETE FROM segments WHERE segid=?", (segid,))
+
+    changed = 0
+    last = len(segments) - 1
+    for x, seg in enumerate(segments):
+        if x in keep or (x == 0 and old[0][2] == seg.digest):
+            segid = keep.get(x, docid)
+            if (x == last) != (segid == oldlast):
+                # the last segment's lines are stored a bit differently
+                c.execute("UPDATE lines SET starts=? WHERE docid=?", (seg.lines, segid))
+        elif x == 0:
+            segid = docid
+            _update_body(c, segid, seg.content, seg.trigrams, seg.lines)
+            changed += 1
+        else:
+            segid = _next_segid(c)
+            _insert_body(c, segid, seg.content, seg.trigrams, seg.lines)
+            changed += 1
+        c.execute("INSERT OR REPLACE INTO segments(segid, docid, start, hash) VALUES(?, ?, ?, ?)",
+                  (segid, docid, seg.start, seg.digest))
+
+    logger.debug("Reindexed %d of %d segments of document %d", changed, len(segments), docid)
+
+def touch_document(c, docid, last_modified):
+    # for when the file was modified but its contents are the same
+    bump_generation(c)
     c.execute("UPDATE files SET last_modified=? WHERE docid=?",
                (last_modified, docid))
-    c.execute("UPDATE files_fts SET body=? WHERE docid=?",
-               (content, docid))
+
+def move_document(c, docid, fname, last_modified):
+    # for when we find a new file with the same contents as one that's gone.
+    # this avoids having to tokenise it again
+    bump_generation(c)
+    c.execute("UPDATE files SET path=?, last_modified=? WHERE docid=?",
+               (fname, last_modified, docid))
+
+@contextmanager
+def bulkload(c, empty=False):
+    """
+    set up the database for loading lots of documents at once, and put it back
+    the way we found it afterwards. while loading, fts4's automerging is
+    disabled and durability is relaxed. if the database started out empty the
+    index on files(path) is dropped too, so the caller must not rely on it and
+    must not add duplicate paths. (otherwise searches may be running against
+    the documents that we commit as we go, and they need it)
+    """
+    synchronous = c.execute("PRAGMA synchronous;").fetchone()[0]
+    journal_mode = c.execute("PRAGMA journal_mode;").fetchone()[0]
+    cache_size = c.execute("PRAGMA cache_size;").fetchone()[0]
+
+    c.execute("PRAGMA synchronous=OFF;")
+    c.execute("PRAGMA cache_size=%d;" % -BULK_CACHE_SIZE)
+    # a crash can corrupt the database with the journal in memory, but if it
+    # started out empty there's nothing to lose. there's no leaving WAL mode
+    # in the middle of a transaction though, and it's nearly as fast
+    memory_journal = empty and journal_mode.lower() != 'wal'
+    if memory_journal:
+        c.execute("PRAGMA journal_mode=MEMORY;")
+
+    for table in FTS_TABLES:
+        c.execute("INSERT INTO %s(%s) VALUES('automerge=0');" % (table, table))
+    if empty:
+        c.execute("DROP INDEX IF EXISTS files_path_idx;")
+
+    try:
+        yield
+
+    except:
+        # the statements below would otherwise implicitly commit whatever
+        # we've loaded so far
+        c.conn.rollback()
+        raise
+
+    finally:
+        create_path_index(c)
+        automerge = 'automerge=%d' % getconfig(c, 'automerge', 0)
+        for table in FTS_TABLES:
+            c.execute("INSERT INTO %s(%s) VALUES(?);" % (table, table), (automerge,))
+
+        if memory_journal:
+            c.execute("PRAGMA journal_mode=%s;" % journal_mode)
+        c.execute("PRAGMA cache_size=%d;" % cache_size)
+        c.execute("PRAGMA synchronous=%d;" % synchronous)
 
 class Cursor(object):
     """
@@ -208,8 +888,45 @@ class Cursor(object):
     def execute(self, stmt, *a, **kw):
         if kw.pop('explain', False):
             self.explain(stmt, *a, **kw)
+        if stats.enabled:
+            return self.timed(stmt, self.c.execute, stmt, *a, **kw)
         return self.c.execute(stmt, *a, **kw)
 
+    def executemany(self, stmt, *a, **kw):
+        if stats.enabled:
+            return self.timed(stmt, self.c.executemany, stmt, *a, **kw)
+        return self.c.executemany(stmt, *a, **kw)
+
+    def timed(self, stmt, fn, *a, **kw):
+        # for --stats. fetching the rows is counted against the statement
+        # too
+        self.stmt = stmt
+        start = time.time()
+        try:
+            return fn(*a, **kw)
+        finally:
+            stats.sql_time(stmt, time.time() - start)
+            if stmt.lstrip()[:6].upper() in ('INSERT', 'UPDATE', 'DELETE'):
+                stats.count('rows written', max(self.c.rowcount, 0))
+
+    def fetched(self, fn, *a):
+        if not stats.enabled or getattr(self, 'stmt', None) is None:
+            return fn(*a)
+        start = time.time()
+        try:
+            return fn(*a)
+        finally:
+            stats.sql_time(self.stmt, time.time() - start, calls=0)
+
+    def fetchone(self):
+        return self.fetched(self.c.fetchone)
+
+    def fetchmany(self, *a):
+        return self.fetched(self.c.fetchmany, *a)
+
+    def fetchall(self):
+        return self.fetched(self.c.fetchall)
+
     @property
     def lastrowid(self):
         return self.c.lastrowid
@@ -1,5 +1,114 @@
+import fnmatch
+# fnmatch.translate writes regexes for python's own re module
+import re as pyre
+
+from ftsdb import re # re or re2
 from ftsdb import Cursor
 
+# backreferences and global flags would change the meaning of the patterns
+# that they're combined with, and two patterns can't name a group the same
+_uncombinable = pyre.compile(r'\\[1-9]|\(\?P[=<]|\(\?[iLmsux]+\)')
+
+def _combine_globs(globs):
+    if not globs:
+        return None
+    return pyre.compile('|'.join('(?:%s)' % fnmatch.translate(g) for g in globs))
+
+class Exclusions(object):
+    """
+    the exclusions table compiled into as few matchers as we can, so that
+    checking a file is a set lookup and two regex matches instead of a loop
+    over every rule. simple names and globs match the basename and regexes
+    match the path relative to the root. simple names and globs that end in
+    a / only match directories
+    """
+    def __init__(self, rules):
+        self.rules = list(rules)
+
+        names, dirnames = set(), set()
+        globs, dirglobs = [], []
+        regexes = []
+        self.regexes = [] # the ones that have to be run on their own
+
+        for typ, expression in self.rules:
+            dironly = typ in ('simple', 'glob') and len(expression) > 1 and expression.endswith('/')
+            if dironly:
+                expression = expression.rstrip('/')
+
+            if typ == 'simple':
+                (dirnames if dironly else names).add(expression)
+            elif typ == 'glob':
+                (dirglobs if dironly else globs).append(expression)
+            elif typ == 're':
+                if _uncombinable.search(expression):
+                    self.regexes.append(re.compile(expression))
+                else:
+                    regexes.append(expression)
+
+        self.names = frozenset(names)
+        self.dirnames = frozenset(dirnames)
+        self.glob = _combine_globs(globs)
+        self.dirglob = _combine_globs(dirglobs)
+        self.regex = None
+        if regexes:
+            try:
+                self.regex = re.compile('|'.join('(?:%s)' % r for r in regexes))
+            except Exception:
+                # something that _uncombinable doesn't know about. they all
+                # compile on their own, since add_ignore checks them
+                self.regexes.extend(re.compile(r) for r in regexes)
+
+    def __nonzero__(self):
+        return bool(self.rules)
+
+    def allow(self, basename, dbpath):
+        """
+        whether a file or directory should be indexed. for a directory,
+        allow_dir has to say so too
+        """
+        if basename in self.names:
+            return False
+        if self.glob is not None and self.glob.match(basename):
+            return False
+        if self.regex is not None and self.regex.search(dbpath):
+            return False
+        for regex in self.regexes:
+            if regex.search(dbpath):
+                return False
+        return True
+
+    def allow_dir(self, basename, dbpath):
+        """
+        whether a directory that allow has already let through should be
+        walked into, according to the rules that only apply to directories
+        """
+        if basename in self.dirnames:
+            return False
+        if self.dirglob is not None and self.dirglob.match(basename):
+            return False
+        return True
+
+    def allow_path(self, dbpath):
+        """
+        like allow and allow_dir for every component of dbpath, which must be
+        a directory, for when we're given a path rather than having walked to
+        it
+        """
+        parts = dbpath.split('/') if dbpath else []
+        for x in xrange(len(parts)):
+            prefix = '/'.join(parts[:x+1])
+            if not (self.allow(parts[x], prefix) and self.allow_dir(parts[x], prefix)):
+                return False
+        return True
+
+def load_exclusions(c):
+    c.execute("SELECT type, expression FROM exclusions;")
+    return Exclusions(c.fetchall())
+
+def forget_dirs(c):
+    # the next sync has to walk everything again to apply the new exclusions
+    c.execute("DELETE FROM dirs;")
+
 def list_ignores(conn):
     for (_id, typ, expression) in conn.execute("""
         SELECT id, type, expression FROM exclusions;
@@ -11,10 +120,13 @@ def add_ignore(conn, typ, expression):
 
     with Cursor(conn) as c:
         c.execute("INSERT INTO exclusions(id, type, expression) VALUES(NULL, ?, ?)", (typ, expression))
-        return c.lastrowid
+        ignoreid = c.lastrowid
+        forget_dirs(c)
+        return ignoreid
 
 def rm_ignore(conn, ignoreid):
     with Cursor(conn) as c:
         if not c.execute("SELECT id FROM exclusions WHERE id = ?", (ignoreid,)).fetchall():
             raise Exception("ignoreid %d not found" % (ignoreid,))
         c.execute("DELETE FROM exclusions WHERE id = ?", (ignoreid,))
+        forget_dirs(c)
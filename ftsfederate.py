@@ -0,0 +1,111 @@
+"""
+search several .fts.dbs at once, like the per-project indexes under a
+monorepo or ones that are nested inside of each other.
+
+each index is searched from the current directory the way that it would be
+on its own: one that covers the current directory is searched under it, and
+one anywhere else is searched in full and its filenames are made relative to
+the current directory. a file that's in more than one of them is returned
+from the deepest one, which is the one that's most likely to be kept up to
+date for it. MATCH results are ranked with the statistics of all of them put
+together (counting those files once for each index), so that the results can
+be merged
+"""
+
+import os
+import os.path
+
+from ftsdb import opendb, Cursor, shard_files, _db_name
+from ftsexclude import load_exclusions
+from ftssearch import search_files, checked
+
+def is_index(root):
+    return os.path.isfile(os.path.join(root, _db_name))
+
+def _exclusions(root):
+    conn = opendb(root)
+    try:
+        with Cursor(conn) as c:
+            return load_exclusions(c)
+    finally:
+        conn.close()
+
+def find_indexes(cwd):
+    """
+    the roots of the indexes that cover cwd or are anywhere under it. unlike
+    findroot, this keeps going after the first one. finding the ones under it
+    means walking the tree, but not into hidden directories or ones that the
+    index that they're in ignores
+    """
+    roots = []
+
+    d = cwd
+    while True:
+        if is_index(d):
+            roots.append(d)
+        parent = os.path.dirname(d)
+        if parent == d:
+            break
+        d = parent
+
+    # the deepest index that each directory we're walking is in, and its
+    # exclusions
+    within = {}
+    if roots:
+        within[cwd] = (roots[0], _exclusions(roots[0]))
+
+    for dirname, subdirs, fnames in os.walk(cwd):
+        if dirname != cwd and _db_name in fnames:
+            roots.append(dirname)
+            within[dirname] = (dirname, _exclusions(dirname))
+        root, exclusions = within.pop(dirname, (None, None))
+
+        keep = []
+        for subdir in subdirs:
+            if subdir.startswith('.'):
+                continue
+            if exclusions:
+                dbpath = os.path.relpath(os.path.join(dirname, subdir), root)
+                if not (exclusions.allow(subdir, dbpath)
+                        and exclusions.allow_dir(subdir, dbpath)):
+                    continue
+                within[os.path.join(dirname, subdir)] = (root, exclusions)
+            keep.append(subdir)
+        subdirs[:] = keep
+
+    return roots
+
+def _databases(cwd, root):
+    # the (fname, prefix, scopes, where)s for search_files to search this
+    # index with
+    conn = opendb(root)
+    try:
+        with Cursor(conn) as c:
+            fnames = shard_files(c) or [os.path.join(root, _db_name)]
+    finally:
+        conn.close()
+
+    rel = os.path.relpath(cwd, root)
+    if rel == '.':
+        prefix, where = '', ''
+    elif rel != '..' and not rel.startswith('../'):
+        # it covers the current directory
+        prefix, where = rel, ''
+    else:
+        prefix, where = '', os.path.relpath(root, cwd)
+
+    return [(fname, prefix, [prefix], where) for fname in fnames]
+
+def federated_search(cwd, roots, terms, mode, checksync=True, **kw):
+    """
+    yield the SearchResults of searching all of the indexes in roots from
+    cwd, warning if any of them are out of date. the keyword arguments are
+    search()'s, except for scopes
+    """
+    roots = set(os.path.abspath(r) for r in roots)
+    dbs = []
+    # deepest first, for search_files to prefer its copies of a file
+    for root in sorted(roots, key=lambda r: (-r.count('/'), r)):
+        dbs.extend(_databases(cwd, root))
+
+    return checked(search_files(dbs, terms, mode, **kw), checksync)
@@ -0,0 +1,100 @@
+"""
+sync a git checkout by asking git what changed instead of walking the tree.
+
+each git sync records the commit that was checked out and the paths that
+differed from it (modified, staged, deleted and untracked files). the next
+one syncs just the paths that differ between that commit and the working
+tree, the ones that differ from the new commit, and the ones that differed
+last time (which may have been put back since). git only knows about the
+files that it doesn't ignore, so changes to ignored files that the database
+indexes anyway are only picked up by a full sync. whenever git can't tell
+us (it's not a git checkout, there's no recorded commit or it's gone),
+everything is synced the usual way
+"""
+
+import json
+import subprocess
+
+from ftsdb import logger, Cursor, getconfig, setconfig
+from ftssync import sync, sync_paths
+from ftsstats import stats
+
+# sync this many changed paths per transaction
+GIT_BATCH = 500
+
+class GitError(Exception):
+    pass
+
+def _git(root, *args):
+    try:
+        p = subprocess.Popen(('git',) + args, cwd=root,
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError as e:
+        raise GitError("couldn't run git: %s" % e)
+    out, err = p.communicate()
+    if p.returncode != 0:
+        raise GitError(err.strip() or "git %s exited with %d" % (args[0], p.returncode))
+    return out
+
+def _paths(out):
+    # git's -z output is NUL-terminated paths
+    return [p for p in out.split('\0') if p]
+
+def git_state(root):
+    """
+    the commit that's checked out in root and the set of paths (relative to
+    root, and only those under it) that differ from it
+    """
+    head = _git(root, 'rev-parse', '--verify', '-q', 'HEAD').strip()
+    dirty = set(_paths(_git(root, 'diff', '--name-only', '-z', '--no-renames', '--relative', 'HEAD')))
+    dirty.update(_paths(_git(root, 'ls-files', '-z', '--others', '--exclude-standard')))
+    return head, dirty
+
+def changed_paths(c, root, head, dirty):
+    """
+    the paths that may have changed since the last git sync, or None if we
+    can't tell
+    """
+    last = getconfig(c, 'git_head')
+    if last is None:
+        return None
+
+    try:
+        changed = set(_paths(_git(root, 'diff', '--name-only', '-z', '--no-renames', '--relative',
+                                  last, head)))
+    except GitError as e:
+        logger.info("Can't diff against the last synced commit %s: %s", last, e)
+        return None
+
+    changed.update(dirty)
+    changed.update(json.loads(getconfig(c, 'git_dirty', '[]')))
+    logger.info("%d paths changed since %s", len(changed), last)
+    return changed
+
+def git_sync(conn, root, jobs=1, trust_dirs=False):
+    """
+    sync everything under root, using git to find the files that changed if
+    we can. trust_dirs is for when we can't
+    """
+    try:
+        with stats.phase('git'):
+            head, dirty = git_state(root)
+            with Cursor(conn) as c:
+                changed = changed_paths(c, root, head, dirty)
+    except GitError as e:
+        logger.info("Not using git to sync: %s", e)
+        sync(conn, root, '', jobs=jobs, trust_dirs=trust_dirs)
+        return
+
+    if changed is None:
+        logger.info("No usable git state recorded, syncing everything")
+        sync(conn, root, '', jobs=jobs, trust_dirs=trust_dirs)
+    else:
+        changed = sorted(changed)
+        for x in xrange(0, len(changed), GIT_BATCH):
+            sync_paths(conn, root, changed[x:x+GIT_BATCH], jobs=jobs)
+            conn.commit()
+
+    with Cursor(conn) as c:
+        setconfig(c, 'git_head', head)
+        setconfig(c, 'git_dirty', json.dumps(sorted(dirty)))
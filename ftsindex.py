@@ -0,0 +1,154 @@
+"""
+using an fts database from python, without going through the command line:
+
+    from ftsindex import Index
+
+    with Index('/path/to/tree') as index:
+        index.sync_paths(['src/bacon.c'])
+        for sr in index.search(['bacon'], limit=10):
+            print sr.filename, sr.rank
+
+an Index opens the database once and keeps its connection (and so sqlite's
+page cache, its cache of prepared statements and the functions that we
+register on it) for as long as it's open. searches are cached until the
+database changes, like the search server's (see ftscache). an Index must only
+be used from the thread that opened it
+"""
+
+import os
+import os.path
+
+from ftsdb import logger, Cursor, opendb, createdb, with_shards, shard_files
+from ftsdb import remove_document, generation, _db_name
+from ftssync import sync, sync_paths
+from ftssearch import search
+from ftscache import ResultCache, CACHE_ENTRIES
+from ftsoptimize import segment_counts, maintain, MAINTAIN_SECONDS
+
+class Index(object):
+    """
+    the fts database in root (which has to be its top directory, not one
+    under it). with create, one is made there if there isn't one already
+    """
+    def __init__(self, root, create=False, shards=0, cache_size=CACHE_ENTRIES):
+        self.root = os.path.abspath(root)
+        if create and not os.path.isfile(os.path.join(self.root, _db_name)):
+            dbfname, conn = createdb(self.root, shards=shards)
+            conn.close()
+            logger.info("Created %s", dbfname)
+        self.conn = opendb(self.root)
+        self.cache = ResultCache(self.conn, entries=cache_size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
+        self.cache.close()
+        self.conn.close()
+
+    def _dbpath(self, path):
+        # paths may be given relative to the root or as full paths under it
+        path = os.path.normpath(os.path.join(self.root, path))
+        dbpath = os.path.relpath(path, self.root)
+        if dbpath == '..' or dbpath.startswith('../'):
+            raise ValueError("%r isn't under %s" % (path, self.root))
+        return '' if dbpath == '.' else dbpath
+
+    def search(self, terms, mode='MATCH', prefix='', combine='OR', scopes=None,
+               limit=None, offset=0, context=None, filenames_only=False):
+        """
+        iterate over the SearchResults for terms (fts4 MATCH queries, or
+        regexes with mode='REGEXP'), like ftssearch.search. prefix is the
+        directory to search in, which the filenames are relative to. the
+        results aren't checked against the files on disk
+        """
+        prefix = self._dbpath(prefix)
+        scopes = None if scopes is None else [self._dbpath(s) for s in scopes]
+        key = (prefix, tuple(terms), mode, combine,
+               tuple(scopes) if scopes is not None else None,
+               limit, offset,
+               tuple(context) if context is not None else None,
+               filenames_only)
+        return iter(self.cache.search(
+            key, lambda: search(self.conn, prefix, terms, mode, combine=combine,
+                                checksync=False, scopes=scopes, limit=limit,
+                                offset=offset, context=context,
+                                filenames_only=filenames_only)))
+
+    def sync(self, jobs=1, trust_dirs=False):
+        """
+        bring the whole index up to date with the disk, like fts --sync
+        """
+        with self.conn:
+            sync(self.conn, self.root, '', jobs=jobs, trust_dirs=trust_dirs)
+
+    def sync_paths(self, paths, jobs=1):
+        """
+        bring just these files and directories up to date with the disk,
+        adding them, updating them or removing them from the index as need
+        be
+        """
+        with self.conn:
+            sync_paths(self.conn, self.root, [self._dbpath(p) for p in paths], jobs=jobs)
+
+    def add(self, path):
+        """
+        index the file at path now (or reindex it if it's changed)
+        """
+        self.sync_paths([path])
+
+    def remove(self, path):
+        """
+        take the file at path out of the index, whether or not it's still on
+        disk. unless it's gone or ignored, the next sync adds it back
+        """
+        dbpath = self._dbpath(path)
+        removed = False
+        with self.conn:
+            for db in with_shards(self.conn):
+                with Cursor(db) as c:
+                    c.execute("SELECT docid FROM files WHERE path = ?", (dbpath,))
+                    for docid, in c.fetchall():
+                        remove_document(c, docid)
+                        removed = True
+            if removed:
+                # or a sync that trusts directory mtimes would skip its
+                # directory, which hasn't changed, and never add it back
+                with Cursor(self.conn) as c:
+                    c.execute("UPDATE dirs SET last_modified = NULL WHERE path = ?",
+                              (os.path.dirname(dbpath),))
+        return removed
+
+    def maintain(self, seconds=MAINTAIN_SECONDS, pages=None):
+        """
+        merge the index incrementally, like fts --maintain, and return what
+        it did
+        """
+        with self.conn:
+            return maintain(self.conn, seconds=seconds, pages=pages)
+
+    def stats(self):
+        """
+        a dict of how many documents are in the index (and how many of them
+        were skipped), its segments, its size on disk and its generation
+        """
+        documents = skipped = 0
+        segments = None
+        with Cursor(self.conn) as c:
+            fnames = [os.path.join(self.root, _db_name)] + shard_files(c)
+        gens = []
+        for db in with_shards(self.conn):
+            with Cursor(db) as c:
+                documents += c.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+                skipped += c.execute("SELECT COUNT(*) FROM skipped").fetchone()[0]
+                gens.append(generation(c))
+            segments = segment_counts(db, segments)
+        return dict(documents=documents,
+                    skipped=skipped,
+                    segments=segments,
+                    shards=len(fnames) - 1,
+                    bytes=sum(os.path.getsize(f) for f in fnames),
+                    generation=tuple(gens))
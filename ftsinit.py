@@ -4,11 +4,13 @@ import sys
 from ftsdb import createdb
 from ftsdb import logger, _db_name
 
-def init(cwd):
+def init(cwd, shards=0, wal=True):
     if os.path.isfile(os.path.join(cwd, _db_name)):
         logger.error("Cowardly refusing to overwrite existing %s", _db_name)
         sys.exit(1)
 
-    dbfname, conn = createdb(cwd)
+    dbfname, conn = createdb(cwd, shards=shards, wal=wal)
     logger.info("Created %s", dbfname)
+    if shards:
+        logger.info("Created %d shards", shards)
     return dbfname
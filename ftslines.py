@@ -0,0 +1,118 @@
+"""
+line numbers and context for search results.
+
+When a document is indexed we store the byte offsets at which each of its
+lines after the first starts, packed into a blob in the lines table. That lets
+us turn the byte offsets of a hit into line numbers with a binary search, and
+pull the lines around it out of the indexed copy of the document, without
+reading or rescanning the file itself. a segmented document (see ftssegments)
+has a row for each segment, relative to the start of the segment.
+"""
+
+import re
+import array
+import bisect
+
+from ftssegments import load_segments, indexed_text
+
+_newline = re.compile('\n')
+
+def line_starts(content, last=True):
+    """
+    the blob to store in the lines table for a document (or a segment of one,
+    which is the last one if last is set)
+    """
+    starts = array.array('I', (m.end() for m in _newline.finditer(content)))
+    if last and starts and starts[-1] == len(content):
+        # a trailing newline doesn't start another line
+        starts.pop()
+    return buffer(starts.tostring())
+
+def load_line_starts(c, docid):
+    starts = array.array('I')
+    for segid, start, end in load_segments(c, docid):
+        c.execute("SELECT starts FROM lines WHERE docid = ?", (segid,))
+        row = c.fetchone()
+        if row is None:
+            continue
+        segstarts = array.array('I')
+        segstarts.fromstring(str(row[0]))
+        if not start:
+            starts.extend(segstarts)
+            continue
+        # it overlaps with the segments before it, so skip the lines that
+        # they've already seen
+        last = starts[-1] if starts else 0
+        starts.extend(start + s for s in segstarts if start + s > last)
+    return starts
+
+def _highlight(text, begin, spans, highlight):
+    # wrap the parts of text (which starts at offset begin in the document)
+    # that are in spans with the highlight codes
+    start_color, end_color = highlight
+    clipped = sorted((max(b, begin) - begin, min(e, begin + len(text)) - begin)
+                     for b, e in spans)
+
+    ret = []
+    pos = 0
+    for b, e in clipped:
+        b = max(b, pos)
+        if e <= b:
+            continue
+        ret.extend((text[pos:b], start_color, text[b:e], end_color))
+        pos = e
+    ret.append(text[pos:])
+    return ''.join(ret)
+
+def context(c, docid, offsets, before=0, after=0, highlight=None):
+    """
+    the lines of the document that contain the hits at offsets (a list of
+    SearchOffsets) and the before and after lines around them, as a list of
+    groups of adjacent lines. each line is a (lineno, matched, text) with
+    1-based line numbers. if highlight is a pair of (start, end) codes, the
+    hits are wrapped in them
+    """
+    starts = load_line_starts(c, docid)
+    nlines = len(starts) + 1
+
+    def start(line):
+        # where the 0-based line starts
+        return starts[line-1] if line else 0
+
+    hits = {} # line -> [(begin, end)]
+    for offset, length in offsets:
+        first = bisect.bisect_right(starts, offset)
+        last = bisect.bisect_right(starts, offset + max(length, 1) - 1)
+        for line in xrange(first, last+1):
+            hits.setdefault(line, []).append((offset, offset + length))
+
+    ranges = []
+    for line in sorted(hits):
+        lo, hi = max(0, line - before), min(nlines - 1, line + after)
+        if ranges and lo <= ranges[-1][1] + 1:
+            # it overlaps or touches the previous one
+            ranges[-1][1] = max(ranges[-1][1], hi)
+        else:
+            ranges.append([lo, hi])
+
+    groups = []
+    for lo, hi in ranges:
+        begin = start(lo)
+        text = indexed_text(c, docid, begin,
+                            start(hi + 1) if hi + 1 < nlines else None)
+
+        group = []
+        for line in xrange(lo, hi + 1):
+            b = start(line) - begin
+            e = start(line + 1) - begin if line + 1 < nlines else len(text)
+            linetext = text[b:e].rstrip('\r\n')
+            if highlight and line in hits:
+                linetext = _highlight(linetext, start(line), hits[line], highlight)
+            group.append((line + 1, line in hits, linetext))
+        groups.append(group)
+
+    if not before and not after and groups:
+        # there's no context to separate them from
+        groups = [[row for rows in groups for row in rows]]
+
+    return groups
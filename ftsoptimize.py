@@ -0,0 +1,214 @@
+"""
+keep the fts4 indexes from slowing down as they're written to.
+
+fts4 keeps each table's index as a set of segments, and every sync adds more
+of them. a search has to read all of them, so they have to be merged now and
+then. there are two ways to do it:
+
+* optimize merges each table into a single segment and then VACUUMs and
+  ANALYZEs the database. it rewrites everything in one transaction, so on a
+  big database nothing else can write to it for minutes
+* maintain runs fts4's incremental merges (merge=X,Y) a few pages at a time,
+  committing after each one, until there's nothing left to merge or it runs
+  out of time or pages. then it gives back free pages to the filesystem with
+  PRAGMA incremental_vacuum. it's cheap enough to run after every sync or
+  from cron
+
+automerge (which makes every write to the index do some merging too) can be
+turned on with set_automerge
+"""
+
+import time
+
+from ftsdb import logger, Cursor, FTS_TABLES, openfile, shard_files, setconfig, with_shards
+from ftsdb import set_auto_vacuum
+from ftsstats import stats
+
+# the most pages that each merge step may write, and how many segments a
+# level of the index needs before its segments are merged
+MERGE_PAGES = 256
+MERGE_SEGMENTS = 4
+
+# how long maintain runs for if it's not told
+MAINTAIN_SECONDS = 1.0
+
+# sqlite's value for PRAGMA auto_vacuum=INCREMENTAL
+INCREMENTAL_VACUUM = 2
+
+def segment_counts(db, counts=None):
+    """
+    add the number of segments in each of db's fts4 tables to counts
+    """
+    if counts is None:
+        counts = dict((table, 0) for table in FTS_TABLES)
+    with Cursor(db) as c:
+        for table in FTS_TABLES:
+            c.execute("SELECT COUNT(*) FROM %s_segdir" % table)
+            counts[table] += c.fetchone()[0]
+    return counts
+
+def _segments(db, table):
+    # a summary of table's segments, to tell whether a merge step changed them
+    return db.execute("""
+        SELECT COUNT(*), TOTAL(end_block), TOTAL(length(root)) FROM %s_segdir
+    """ % table).fetchone()
+
+def _count_blocks(db):
+    # count the blocks that are written to each table's index in
+    # temp.merge_blocks. (a merge doesn't write them in blockid order, so that
+    # can't tell us)
+    db.execute("CREATE TEMP TABLE IF NOT EXISTS merge_blocks(tbl TEXT PRIMARY KEY, blocks INTEGER);")
+    for table in FTS_TABLES:
+        db.execute("INSERT OR REPLACE INTO temp.merge_blocks VALUES(?, 0);", (table,))
+        db.execute("""
+            CREATE TEMP TRIGGER IF NOT EXISTS merge_blocks_%s AFTER INSERT ON main.%s_segments
+            BEGIN UPDATE merge_blocks SET blocks = blocks + 1 WHERE tbl = '%s'; END;
+        """ % (table, table, table))
+
+def _uncount_blocks(db):
+    for table in FTS_TABLES:
+        db.execute("DROP TRIGGER IF EXISTS temp.merge_blocks_%s;" % table)
+    db.execute("DROP TABLE IF EXISTS temp.merge_blocks;")
+
+def _pending(db, table):
+    # whether a merge step would have anything to do: a level with enough
+    # segments to merge (which includes one that's partly merged, since its
+    # segments are only removed once it's done)
+    return db.execute("""
+        SELECT 1 FROM %s_segdir GROUP BY level HAVING COUNT(*) >= ? LIMIT 1
+    """ % table, (MERGE_SEGMENTS,)).fetchone() is not None
+
+def report(done):
+    """
+    print what optimize or maintain did
+    """
+    for table in FTS_TABLES:
+        print "%s: %d segments before, %d after" % (table, done['before'][table], done['after'][table])
+    for name, value in sorted(done.iteritems()):
+        if name not in ('before', 'after'):
+            print "%s: %s" % (name.replace('_', ' '), value)
+
+def optimize(conn):
+    """
+    merge everything and rewrite the database, however long it takes. returns
+    the segment counts before and after for report()
+    """
+    started = time.time()
+    before = dict((table, 0) for table in FTS_TABLES)
+    after = dict(before)
+
+    for db in with_shards(conn):
+        segment_counts(db, before)
+        with Cursor(db) as c:
+            for table in FTS_TABLES:
+                logger.debug("OPTIMIZE %s", table)
+                c.execute("INSERT INTO %s(%s) VALUES('optimize');" % (table, table))
+            # this also switches databases made before maintain existed over
+            # to incremental vacuuming
+            set_auto_vacuum(db)
+            logger.debug("VACUUM;")
+            c.execute("VACUUM;")
+            logger.debug("ANALYZE;")
+            c.execute("ANALYZE;")
+        segment_counts(db, after)
+
+    return dict(before=before, after=after, seconds='%.2f' % (time.time() - started))
+
+def maintain(conn, seconds=MAINTAIN_SECONDS, pages=None):
+    """
+    merge the indexes a step at a time for up to seconds seconds or pages
+    pages (None for no limit), and then release the free pages that we can
+    in what's left of it. returns the segment counts before and after and
+    how much was done for report()
+    """
+    started = time.time()
+
+    with Cursor(conn) as c:
+        fnames = shard_files(c)
+    dbs = [conn] + [openfile(fname) for fname in fnames]
+
+    try:
+        before = dict((table, 0) for table in FTS_TABLES)
+        for db in dbs:
+            segment_counts(db, before)
+
+        def left():
+            # how many more pages we may write, or 0 if we're out of time
+            if seconds is not None and time.time() - started >= seconds:
+                return 0
+            if pages is None:
+                return MERGE_PAGES
+            return max(min(MERGE_PAGES, pages - written), 0)
+
+        # a merge step is run on each table of each database in turn, so
+        # that they all get some of the budget
+        written = steps = 0
+        todo = [(db, table) for db in dbs for table in FTS_TABLES]
+        counted = dict((job, 0) for job in todo)
+        for db in dbs:
+            _count_blocks(db)
+        with stats.phase('merge'):
+            while todo and left():
+                for db, table in list(todo):
+                    step = left()
+                    if not step:
+                        break
+                    segments = _segments(db, table)
+                    with db:
+                        db.execute("INSERT INTO %s(%s) VALUES('merge=%d,%d');"
+                                   % (table, table, step, MERGE_SEGMENTS))
+                    blocks = db.execute("SELECT blocks FROM temp.merge_blocks WHERE tbl = ?;",
+                                        (table,)).fetchone()[0] - counted[db, table]
+                    counted[db, table] += blocks
+                    written += blocks
+                    steps += 1
+                    stats.count('merge steps')
+                    stats.count('merge blocks', blocks)
+                    if not blocks and _segments(db, table) == segments:
+                        # there was nothing to merge
+                        todo.remove((db, table))
+
+        released = 0
+        unvacuumed = 0
+        with stats.phase('vacuum'):
+            for db in dbs:
+                if db.execute("PRAGMA auto_vacuum;").fetchone()[0] != INCREMENTAL_VACUUM:
+                    unvacuumed += 1
+                    continue
+                free = db.execute("PRAGMA freelist_count;").fetchone()[0]
+                if pages is not None:
+                    free = min(free, max(pages - written, 0))
+                if free and (seconds is None or time.time() - started < seconds):
+                    # the pages are released as the rows are stepped through
+                    db.execute("PRAGMA incremental_vacuum(%d);" % free).fetchall()
+                    released += free
+                    written += free
+        if unvacuumed:
+            logger.info("%d databases weren't made with incremental vacuuming. "
+                        "run --optimize once to switch them over", unvacuumed)
+
+        after = dict((table, 0) for table in FTS_TABLES)
+        for db in dbs:
+            segment_counts(db, after)
+        return dict(before=before, after=after,
+                    merge_steps=steps,
+                    pages_released=released,
+                    finished='no' if any(_pending(db, table) for db, table in todo) else 'yes',
+                    seconds='%.2f' % (time.time() - started))
+
+    finally:
+        _uncount_blocks(conn)
+        for db in dbs[1:]:
+            db.close()
+
+def set_automerge(conn, n):
+    """
+    have every write to the indexes merge segments once there are n of them
+    on a level (0 turns it off, 1 is fts4's default of 8)
+    """
+    for db in with_shards(conn):
+        with Cursor(db) as c:
+            # ftsdb.bulkload turns it off while loading, and puts this back
+            setconfig(c, 'automerge', n)
+            for table in FTS_TABLES:
+                c.execute("INSERT INTO %s(%s) VALUES('automerge=%d');" % (table, table, n))
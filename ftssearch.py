@@ -1,10 +1,20 @@
 import os
 import stat
+import time
+import signal
 import itertools
-from collections import namedtuple
+import threading
+import Queue
+import multiprocessing
+from collections import namedtuple, OrderedDict
 
-from ftsdb import prefix_expr
-from ftsdb import logger, Cursor
+from ftsdb import re # re or re2
+from ftsdb import prefix_clause
+from ftsdb import logger, Cursor, connect, shard_files, unpack_matchinfo, varints
+from ftstrigrams import trigrams_enabled, trigram_query
+from ftslines import context
+from ftssegments import FILE_DOCID, segmented, load_segments, owns
+from ftsstats import stats
 
 snippet_color        = '\x1b[01;33m'
 snippet_end_color    = '\x1b[00m'
@@ -13,6 +23,25 @@ snippet_elipsis      = ''.join([snippet_color, '...', snippet_end_color])
 filename_color       = '\x1b[01;31m'
 filename_end_color   = '\x1b[00m'
 
+# how much a hit in each column of files_fts counts towards a document's rank
+RANK_WEIGHTS = (1.0,)
+
+# how many results to work out offsets and snippets for at a time. working
+# them out means reading each term's doclist again, so when iterating through
+# all of the results the pages start at PAGE_SIZE and double up to
+# MAX_PAGE_SIZE
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 2000
+
+# how long to wait for a worker's results before checking for a ^C
+POOL_POLL = 1
+
+# how many threads to stat() the results' files on to see whether they've
+# changed since they were indexed, and how long to wait for them after the
+# last result before giving up on the ones that they haven't got to
+STALE_THREADS = 4
+STALE_TIMEOUT = 1.0
+
 def grouper(n, iterable, fillvalue=None):
     "Collect data into fixed-length chunks or blocks"
     # from http://docs.python.org/2/library/itertools.html#recipes
@@ -23,12 +52,32 @@ def grouper(n, iterable, fillvalue=None):
 SearchOffset = namedtuple('SearchOffset', ('offset', 'length'))
 
 class SearchResult(object):
-    __slots__ = ('filename', 'offsets', 'snippet')
+    __slots__ = ('filename', 'offsets', 'snippet', 'last_modified', 'lines', 'rank')
 
-    def __init__(self, filename, offsets, snippet):
+    def __init__(self, filename, offsets, snippet, last_modified=None, rank=None):
         self.filename = filename
         self.offsets = self.parse_offsets(offsets)
         self.snippet = snippet
+        self.last_modified = last_modified
+        # bigger is better. regex results don't have one
+        self.rank = rank
+        # groups of (lineno, matched, text) from ftslines.context, if they
+        # were asked for
+        self.lines = None
+
+    def to_json(self):
+        return dict(filename=self.filename,
+                    offsets=[list(o) for o in self.offsets],
+                    snippet=self.snippet,
+                    last_modified=self.last_modified,
+                    lines=self.lines)
+
+    @classmethod
+    def from_json(cls, d):
+        sr = cls(d['filename'], '', d['snippet'], d['last_modified'])
+        sr.offsets = [SearchOffset(*o) for o in d['offsets']]
+        sr.lines = d.get('lines')
+        return sr
 
     def parse_offsets(self, offsets):
         ret = []
@@ -52,57 +101,635 @@ class SearchResult(object):
         else:
             return s
 
-    def format(self, color=False):
-        if self.snippet:
+    def format(self, color=False, line_numbers=False):
+        if self.lines is not None:
+            # like grep: numbered lines, with ':' for the ones that matched and
+            # '-' for the context around them, and '--' between groups
+            out = [self.colorize(self.filename, color)]
+            for x, group in enumerate(self.lines):
+                if x:
+                    out.append('--')
+                for lineno, matched, text in group:
+                    if line_numbers:
+                        out.append('%d%s%s' % (lineno, ':' if matched else '-', text))
+                    else:
+                        out.append(text)
+            return '\n'.join(out)
+        elif self.snippet:
                 return self.colorize(self.filename, color) + ':\n' + '\n'.join('\t' + x for x in self.snippet.split('\n'))
         else:
             return self.colorize(self.filename, color)
 
-def search(conn, prefix, term, mode, checksync = True, color=False):
-    assert mode in ('MATCH', 'REGEXP')
+def is_stale(fname, last_modified):
+    """
+    whether the file is known to be missing or newer than its indexed copy
+    """
+    try:
+        st = os.stat(fname)
+        stats.count('stat calls')
+        return int(st[stat.ST_MTIME]) > last_modified
+    except OSError:
+        return True
 
-    with Cursor(conn) as c:
-        prefix = prefix or ''
-        prefixexpr = prefix_expr(prefix)
-        needsync = 0
+def warn_stale(needsync):
+    if needsync:
+        logger.warning("%d files were missing or out-of-date, you may need to resync", needsync)
+
+class StaleCheck(object):
+    """
+    is_stale() the results on a few threads while they're being printed, so
+    that the check doesn't hold them up. finish() waits a bounded time for
+    the ones that are left (which only matters if stat() is slow, like on
+    NFS) and warns if any were stale
+
+        check = StaleCheck()
+        for sr in results:
+            check.add(sr)
+            print sr.filename
+        check.finish()
+    """
+    def __init__(self, threads=STALE_THREADS):
+        self.todo = Queue.Queue()
+        self.lock = threading.Lock()
+        self.nthreads = threads
+        self.threads = []
+        self.added = self.checked = self.stale = 0
+
+    def check(self):
+        while True:
+            item = self.todo.get()
+            if item is None:
+                return
+            stale = is_stale(*item)
+            with self.lock:
+                self.checked += 1
+                self.stale += stale
+
+    def add(self, sr):
+        if not self.threads:
+            # started on the first result, so that there's nothing to pay
+            # when there aren't any
+            for x in xrange(self.nthreads):
+                t = threading.Thread(target=self.check, name='fts-stale-%d' % x)
+                t.daemon = True
+                t.start()
+                self.threads.append(t)
+        self.added += 1
+        self.todo.put((sr.filename, sr.last_modified))
+
+    def finish(self, timeout=STALE_TIMEOUT):
+        for t in self.threads:
+            self.todo.put(None)
+        deadline = time.time() + timeout
+        for t in self.threads:
+            t.join(max(deadline - time.time(), 0))
+
+        with self.lock:
+            if self.checked < self.added:
+                logger.info("Gave up checking %d of %d files for changes",
+                            self.added - self.checked, self.added)
+            warn_stale(self.stale)
+
+def _shift_offsets(offsets, start, end):
+    # the offsets() of a segment from start to end as offsets into the whole
+    # document, leaving out the ones that belong to its neighbours
+    if not start and end is None:
+        return offsets
+    nums = map(int, offsets.split())
+    return ' '.join('%d %d %d %d' % (colno, termno, start + offset, length)
+                    for colno, termno, offset, length in grouper(4, nums)
+                    if owns(start, end, start + offset))
+
+def _match_query(terms, combine, inscope, segmented=False, corpus=False):
+    # each term is looked up in the fts index on its own and the hits are
+    # combined, so that a document matching several terms comes back once
+    # with the sum of their ranks. with corpus, they're ranked with the
+    # statistics in :corpusN instead of this database's
+    weights = ', '.join('%f' % w for w in RANK_WEIGHTS)
+    docid = FILE_DOCID if segmented else 'ft.docid'
+    if corpus:
+        rank = "bm25_corpus(matchinfo(ft.files_fts, 'pcnalx'), :corpus%(n)d, " + weights + ")"
+    else:
+        rank = "bm25(matchinfo(ft.files_fts, 'pcnalx'), " + weights + ")"
+
+    # the fts index finds matches anywhere in the database, so skip the
+    # ones outside of the scope before ranking them
+    scoped = ''
+    if inscope != '1':
+        scoped = "AND %s IN (SELECT docid FROM files f WHERE %s)" % (docid, inscope)
+
+    lookup = """
+        SELECT %s AS docid,
+               %s AS rank
+          FROM files_fts ft
+         WHERE ft.body MATCH :term%%(n)d
+           %s
+    """ % (docid, rank, scoped)
+    if segmented:
+        # a document's rank for a term is its best segment's. the LIMIT stops
+        # sqlite from flattening the lookup into the aggregate, where
+        # matchinfo isn't allowed
+        lookup = """
+            SELECT docid, max(rank) AS rank
+              FROM (%s LIMIT -1)
+          GROUP BY docid
+        """ % lookup
+
+    lookups = ' UNION ALL '.join(lookup % dict(n=x) for x in xrange(len(terms)))
+
+    if len(terms) > 1:
+        having = "HAVING count(*) = %d" % len(terms) if combine == 'AND' else ''
+        lookups = """
+            SELECT docid, sum(rank) AS rank
+              FROM (%s)
+          GROUP BY docid
+            %s
+        """ % (lookups, having)
+
+    # the rank is computed once per matching document, and the best ones come
+    # first. with a LIMIT, sqlite only keeps the best limit+offset of them
+    # while sorting
+    return """
+        SELECT f.docid, f.path, f.last_modified, r.rank
+          FROM (%s) r, files f
+         WHERE f.docid = r.docid
+      ORDER BY r.rank DESC
+         LIMIT :limit OFFSET :offset
+    """ % lookups
+
+def _regexp_query(c, terms, combine, inscope, segmented=False):
+    # every regex is tried against each document in a single scan. matchinfo
+    # has nothing to say about a regex, so these aren't ranked and come back
+    # as they're found
+    params = {}
+
+    candidates = ''
+    if trigrams_enabled(c):
+        # only run the regexes against documents that have the trigrams that
+        # they need
+        queries = [trigram_query(term) for term in terms]
+        for term, query in zip(terms, queries):
+            if query is None:
+                logger.debug("No trigrams in %r", term)
+
+        if combine == 'AND':
+            # a document has to have the trigrams of every regex that needs
+            # some, and the ones that don't can't narrow it down
+            queries = [q for q in queries if q is not None]
+        elif None in queries:
+            # but if any one of them can match anything, so can the search
+            queries = []
+
+        if queries:
+            lookups = ["SELECT docid FROM files_trigrams WHERE files_trigrams MATCH :grams%d" % x
+                       for x in xrange(len(queries))]
+            if combine == 'AND' and len(queries) > 1 and segmented:
+                # a document's trigrams may be spread over its segments, so
+                # the documents are intersected and then only their segments
+                # with some of them are scanned
+                docs = ["SELECT %s FROM files_trigrams ft WHERE ft.grams MATCH :grams%d" % (FILE_DOCID, x)
+                        for x in xrange(len(queries))]
+                candidates = "AND ft.docid IN (%s) AND f.docid IN (%s)" % (
+                    ' UNION ALL '.join(lookups), ' INTERSECT '.join(docs))
+            elif combine == 'AND':
+                candidates = "AND ft.docid IN (%s)" % ' INTERSECT '.join(lookups)
+            else:
+                candidates = "AND ft.docid IN (%s)" % ' UNION ALL '.join(lookups)
+            for x, query in enumerate(queries):
+                params['grams%d' % x] = query
+        else:
+            logger.debug("Doing a full scan")
+
+    exprs = ', '.join(':term%d' % x for x in xrange(len(terms)))
+    if len(terms) > 1:
+        matches = "regexp_%s(ft.body, %s)" % ('all' if combine == 'AND' else 'any', exprs)
+    else:
+        matches = "ft.body REGEXP :term0"
+
+    if segmented:
+        # the segments of a document are matched separately, so with AND they
+        # only have to match all of the regexes between them. grouping by
+        # path lets sqlite return them in the order of the path index as
+        # they're found
+        having = ''
+        if combine == 'AND' and len(terms) > 1:
+            matches = '1'
+            having = "HAVING bit_or(regexp_mask(ft.body, %s)) = %d" % (exprs, (1 << len(terms)) - 1)
+        return """
+            SELECT f.docid, f.path, f.last_modified, NULL
+              FROM files f LEFT JOIN segments s ON s.docid = f.docid, files_fts ft
+             WHERE ft.docid = coalesce(s.segid, f.docid)
+               AND %(inscope)s
+               %(candidates)s
+               AND %(matches)s
+          GROUP BY f.path
+            %(having)s
+             LIMIT :limit OFFSET :offset
+        """ % dict(inscope=inscope, candidates=candidates, matches=matches,
+                   having=having), params
+
+    return """
+        SELECT f.docid, f.path, f.last_modified, NULL
+          FROM files_fts ft, files f
+         WHERE f.docid = ft.docid
+           AND %(inscope)s
+           %(candidates)s
+           AND %(matches)s
+         LIMIT :limit OFFSET :offset
+    """ % dict(inscope=inscope, candidates=candidates, matches=matches), params
+
+class SearchCursor(object):
+    """
+    the results of a search for documents matching any (combine='OR') or all
+    (combine='AND') of terms, best first. each document is returned once.
+    scopes are the directories to search in (by default, prefix) and
+    filenames are returned relative to prefix. if context is a pair of
+    (before, after) then each result's lines are filled in with its matching
+    lines and that many lines around them. corpus is combine_corpus()'s
+    statistics to rank MATCHes with, when they're to be compared with the
+    results from other databases. with filenames_only, the results have no
+    offsets, snippets or lines.
+
+    the matching documents are found and ranked up front, but their offsets
+    and snippets are only worked out a page at a time as they're fetched:
+
+        with SearchCursor(conn, prefix, ['bacon'], 'MATCH', limit=20) as sc:
+            first = sc.fetchmany(10)
+            rest = sc.fetchmany(10)
+    """
+    def __init__(self, conn, prefix, terms, mode, combine='OR', color=False,
+                 scopes=None, limit=None, offset=0, context=None, corpus=None,
+                 filenames_only=False):
+        assert mode in ('MATCH', 'REGEXP')
+        assert combine in ('AND', 'OR')
+
+        self.conn = conn
+        self.prefix = prefix or ''
+        # searching for the same thing twice doesn't change anything
+        self.terms = list(OrderedDict.fromkeys(terms))
+        self.mode = mode
+        self.combine = combine
+        self.color = color
+        self.scopes = [self.prefix] if scopes is None else scopes
+        self.limit = limit
+        self.offset = offset
+        self.corpus = corpus
+        self.filenames_only = filenames_only
+        self.context = None if filenames_only else context
+
+        self.done = not self.terms
+        self.segmented = False
+
+    def __enter__(self):
+        self.cursor = Cursor(self.conn)
+        self.c = self.cursor.__enter__()
+        if not self.done:
+            self.execute()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.cursor.__exit__(type, value, traceback)
+
+    def execute(self):
+        inscope, params = prefix_clause('f.path', self.scopes)
+        self.segmented = segmented(self.c)
+
+        if self.mode == 'MATCH':
+            query = _match_query(self.terms, self.combine, inscope, self.segmented,
+                                 corpus=self.corpus is not None)
+            if self.corpus is not None:
+                params.update(('corpus%d' % x, None if co is None else buffer(co))
+                              for x, co in enumerate(self.corpus))
+        else:
+            query, grams = _regexp_query(self.c, self.terms, self.combine, inscope,
+                                         self.segmented)
+            params.update(grams)
+
+        params.update(('term%d' % x, term) for x, term in enumerate(self.terms))
+        params.update(limit=-1 if self.limit is None else self.limit,
+                      offset=self.offset)
+
+        with stats.phase('query'):
+            self.c.execute(query, params)
+
+    def shortpath(self, path):
+        # if they're in a subdirectory, deprefix the filename
+        prefix = self.prefix
+        if not prefix:
+            return path
+        elif path.startswith(prefix + '/'):
+            return path[len(prefix)+1:]
+        else:
+            # from a --search-in outside of the current directory
+            return os.path.relpath(path, prefix)
+
+    def snippets(self, docids):
+        """
+        the offsets and snippets of the given documents, for each of the
+        terms that they match
+        """
+        found = {}
+        if self.mode != 'MATCH' or not docids:
+            # the fts functions have nothing to say about a regex
+            return found
+
+        with Cursor(self.conn) as c:
+            # segid -> (docid, start, end) for the segments of the segmented
+            # ones
+            segments = {}
+            if self.segmented:
+                for docid in docids:
+                    for segid, start, end in load_segments(c, docid):
+                        segments[segid] = (docid, start, end)
+            ftdocids = set(docids).union(segments)
+
+            for term in self.terms:
+                hits = {}
+                c.execute("""
+                    SELECT ft.docid,
+                           offsets(ft.files_fts),
+                           snippet(ft.files_fts, ?, ?, ?, -1, -10)
+                      FROM files_fts ft
+                     WHERE ft.body MATCH ?
+                       AND ft.docid IN (%s)
+                """ % ', '.join('%d' % docid for docid in ftdocids),
+                    (snippet_color if self.color else '',
+                     snippet_end_color if self.color else '',
+                     snippet_elipsis if self.color else '...',
+                     term))
+                for ftdocid, offsets, snippet in c:
+                    docid, start, end = segments.get(ftdocid, (ftdocid, 0, None))
+                    offsets = _shift_offsets(offsets, start, end)
+                    hits.setdefault(docid, []).append((start, offsets, snippet))
+
+                for docid, seghits in hits.iteritems():
+                    # one snippet per term, from the first segment with a hit
+                    # that's its own
+                    seghits.sort()
+                    snippet = next((s for start, o, s in seghits if o), seghits[0][2])
+                    found.setdefault(docid, []).append(
+                        (' '.join(o for start, o, s in seghits if o), snippet))
+
+        return dict((docid, (' '.join(o for o, s in hits),
+                             '\n'.join(s for o, s in hits)))
+                    for docid, hits in found.iteritems())
+
+    def regexp_offsets(self, c, docid):
+        # the fts functions can't tell us where a regex matched, so we have to
+        # look for ourselves
+        offsets = []
+        for segid, start, end in load_segments(c, docid):
+            c.execute("SELECT body FROM files_fts WHERE docid = ?", (segid,))
+            body = c.fetchone()[0] or ''
+            offsets.extend(SearchOffset(start + m.start(), m.end() - m.start())
+                           for term in self.terms
+                           for m in re.finditer(term, body)
+                           if owns(start, end, start + m.start()))
+        return offsets
+
+    def fetchmany(self, size=PAGE_SIZE):
+        """
+        the next (up to) size results, or an empty list when there are no
+        more
+        """
+        if self.done:
+            return []
+
+        with stats.phase('fetch'):
+            rows = self.c.fetchmany(size)
+        if len(rows) < size:
+            self.done = True
+        stats.count('results', len(rows))
+
+        if self.filenames_only:
+            return [SearchResult(self.shortpath(path), '', '', last_modified, rank)
+                    for docid, path, last_modified, rank in rows]
+
+        with stats.phase('snippets'):
+            snippets = self.snippets([docid for docid, path, last_modified, rank in rows])
+
+        results = []
+        for docid, path, last_modified, rank in rows:
+            offsets, snippet = snippets.get(docid, ('', ''))
+            results.append(SearchResult(self.shortpath(path), offsets, snippet,
+                                        last_modified, rank))
+
+        if self.context is not None:
+            before, after = self.context
+            highlight = (snippet_color, snippet_end_color) if self.color else None
+            with stats.phase('context'), Cursor(self.conn) as c:
+                for (docid, path, last_modified, rank), sr in zip(rows, results):
+                    if self.mode == 'REGEXP':
+                        sr.offsets = self.regexp_offsets(c, docid)
+                    sr.lines = context(c, docid, sr.offsets, before, after, highlight)
+
+        return results
+
+    def __iter__(self):
+        # without snippets, a page costs no more than its rows
+        size = MAX_PAGE_SIZE if self.filenames_only else PAGE_SIZE
+        while True:
+            page = self.fetchmany(size)
+            if not page:
+                return
+            for sr in page:
+                yield sr
+            size = min(size*2, MAX_PAGE_SIZE)
+
+def corpus_stats(c, terms):
+    """
+    what the ranks of the terms depend on in this database: its number of
+    rows and the total length of each column, and the matchinfo of a row that
+    each term matches (or None if it doesn't match any)
+    """
+    # fts4's totals are the number of rows, the number of tokens in each
+    # column, and then the size of everything in bytes
+    c.execute("SELECT value FROM files_fts_stat WHERE id = 0")
+    row = c.fetchone()
+    totals = varints(row[0]) if row else [0]
+
+    hits = []
+    for term in terms:
         c.execute("""
-            SELECT f.path, f.last_modified,
-                   offsets(ft.files_fts),
-                   snippet(ft.files_fts, ?, ?, ?, -1, -10)
-              FROM files f, files_fts ft
-             WHERE f.docid = ft.docid
-               AND (? = '' OR f.path LIKE ? ESCAPE '\\') -- use the prefix if present -- ESCAPE disables the LIKE optimization :(
-               AND ft.body %(mode)s ?
-          -- TODO: this runs simple_rank, which calls a Python function, many
-          -- times per row. we can decompose this to a subselect to avoid this
-          ORDER BY simple_rank(matchinfo(ft.files_fts))
-        """ % dict(mode=mode), (snippet_color if color else '',
-                                snippet_end_color if color else '',
-                                snippet_elipsis if color else '...',
-                                prefix,
-                                prefixexpr,
-                                term,))
-        for (path, last_modified, offsets, snippet) in c:
-
-            if prefix:
-                assert path.startswith(prefix)
-
-            # if they're in a subdirectory, deprefix the filename
-            shortpath = path[len(prefix)+1:] if prefix else path
-
-            if checksync:
-                # check if the returned files are known to be out of date. this
-                # can be skipped when checksync is False (which means that a
-                # sync was done before starting the search)
-                try:
-                    st = os.stat(shortpath)
-                    if int(st[stat.ST_MTIME]) > last_modified:
-                        needsync += 1
-                except OSError:
-                    needsync += 1
-
-            yield SearchResult(shortpath, offsets, snippet)
-
-        if needsync:
-            logger.warning("%d files were missing or out-of-date, you may need to resync", needsync)
+            SELECT matchinfo(ft.files_fts, 'pcnalx')
+              FROM files_fts ft
+             WHERE ft.body MATCH ?
+             LIMIT 1
+        """, (term,))
+        row = c.fetchone()
+        hits.append(str(row[0]) if row else None)
+
+    return totals[0], totals[1:], hits
+
+def combine_corpus(stats):
+    """
+    a matchinfo for each term (or None) from several databases'
+    corpus_stats, as if they were all one database, for bm25_corpus
+    """
+    rows = sum(st[0] for st in stats)
+    lengths = [sum(ls) for ls in zip(*[st[1] for st in stats if st[0]])]
+
+    corpus = []
+    for term in zip(*[st[2] for st in stats]):
+        mis = [unpack_matchinfo(h) for h in term if h is not None]
+        if not mis:
+            corpus.append(None)
+            continue
+
+        co = mis[0]
+        ncols = co[1]
+        co[2] = rows
+        for col in xrange(ncols):
+            # the same rounding as matchinfo's
+            co[3+col] = (lengths[col] + rows/2) / rows if rows else 0
+            co[3+ncols+col] = 0
+        # each phrase's (hits in this row, hits in all rows, rows with hits)
+        for x in xrange(3+2*ncols, len(co), 3):
+            co[x] = 0
+            co[x+1] = sum(mi[x+1] for mi in mis)
+            co[x+2] = sum(mi[x+2] for mi in mis)
+        corpus.append(co.tostring())
+
+    return corpus
+
+# the worker processes that search_files uses, and their connections to the
+# databases. they're kept for as long as we run so that a --serve stays warm
+_pool = None
+_conns = {}
+
+def _ignore_interrupts():
+    # ^C is the parent's to deal with
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def _search_pool(size):
+    global _pool
+    if _pool is None:
+        _pool = multiprocessing.Pool(min(size, multiprocessing.cpu_count()),
+                                     _ignore_interrupts)
+    return _pool
+
+def _connection(fname):
+    # runs in a worker process
+    conn = _conns.get(fname)
+    if conn is None:
+        conn = _conns[fname] = connect(fname)
+    return conn
+
+def _corpus_file(args):
+    fname, terms = args
+    with Cursor(_connection(fname)) as c:
+        return corpus_stats(c, terms)
+
+def _search_file(args):
+    # SearchResults don't pickle, so they're sent back the same way that the
+    # search server sends them
+    x, fname, prefix, scopes, terms, mode, kw = args
+    with SearchCursor(_connection(fname), prefix, terms, mode, scopes=scopes, **kw) as sc:
+        return x, [(sr.rank, sr.to_json()) for sr in sc]
+
+def _unordered(found):
+    # the results of an imap_unordered as they arrive. a next() without a
+    # timeout can't be interrupted with ^C
+    while True:
+        try:
+            yield found.next(POOL_POLL)
+        except multiprocessing.TimeoutError:
+            continue
+        except StopIteration:
+            return
+
+def search_files(dbs, terms, mode, limit=None, offset=0, **kw):
+    """
+    search several databases at once, on up to one process per core. dbs is
+    a list of (fname, prefix, scopes, where): the database file, the prefix
+    and scopes to search it with, and the directory to put in front of the
+    filenames that it returns. a file that's in more than one of them is only
+    returned once, from the first of them in dbs for a MATCH or the first to
+    find it for a regex.
+
+    MATCH results are ranked with the statistics of all of the databases put
+    together so that they can be merged. regex results are yielded as each
+    database finishes
+    """
+    pool = _search_pool(len(dbs))
+
+    if mode == 'MATCH' and len(dbs) > 1:
+        found = pool.imap_unordered(_corpus_file, [(fname, terms) for fname, p, s, w in dbs])
+        kw['corpus'] = combine_corpus(list(_unordered(found)))
+
+    # any one of them may have all of the results that we want
+    kw['limit'] = None if limit is None else offset + limit
+    tasks = [(x, fname, prefix, scopes, terms, mode, kw)
+             for x, (fname, prefix, scopes, where) in enumerate(dbs)]
+
+    def found():
+        for x, rows in _unordered(pool.imap_unordered(_search_file, tasks)):
+            where = dbs[x][3]
+            for rank, d in rows:
+                sr = SearchResult.from_json(d)
+                sr.rank = rank
+                if where:
+                    sr.filename = os.path.join(where, sr.filename)
+                yield x, sr
+
+    results = found()
+    if mode == 'MATCH':
+        first = {}
+        for x, sr in results:
+            key = os.path.normpath(sr.filename)
+            if key not in first or x < first[key][0]:
+                first[key] = (x, sr)
+        results = sorted(first.itervalues(),
+                         key=lambda (x, sr): (-sr.rank, sr.filename))
+
+    def distinct():
+        seen = set()
+        for x, sr in results:
+            key = os.path.normpath(sr.filename)
+            if key not in seen:
+                seen.add(key)
+                yield sr
+
+    end = None if limit is None else offset + limit
+    for sr in itertools.islice(distinct(), offset, end):
+        yield sr
+
+def _search_one(conn, prefix, terms, mode, **kw):
+    with SearchCursor(conn, prefix, terms, mode, **kw) as sc:
+        for sr in sc:
+            yield sr
+
+def checked(results, checksync=True):
+    """
+    yield results, warning afterwards if any of them are out of date. the
+    check can be skipped when checksync is False (which means that a sync was
+    done before starting the search)
+    """
+    if not checksync:
+        for sr in results:
+            yield sr
+        return
+
+    check = StaleCheck()
+    for sr in results:
+        check.add(sr)
+        yield sr
+    check.finish()
+
+def search(conn, prefix, terms, mode, combine='OR', checksync=True, color=False,
+           scopes=None, limit=None, offset=0, context=None, filenames_only=False):
+    """
+    yield the SearchResults of a SearchCursor (or of one on each shard of a
+    sharded database), warning if any of them are out of date
+    """
+    with Cursor(conn) as c:
+        shards = shard_files(c)
+    kw = dict(combine=combine, color=color, limit=limit, offset=offset,
+              context=context, filenames_only=filenames_only)
+    if shards:
+        results = search_files([(fname, prefix, scopes, '') for fname in shards],
+                               terms, mode, **kw)
+    else:
+        results = _search_one(conn, prefix, terms, mode, scopes=scopes, **kw)
 
+    return checked(results, checksync)
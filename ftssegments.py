@@ -0,0 +1,158 @@
+"""
+big documents, indexed in segments.
+
+fts4 has to tokenise all of a document's body again whenever it changes, so a
+file bigger than SEGMENT_SIZE is instead indexed as a series of overlapping
+segments. each segment is its own row in files_fts (and files_trigrams and
+lines) and the segments table maps them back to the file's entry in files. the
+first segment's row has the file's docid, and the rest have negative docids
+so that they can't collide with any file's. when the file changes, only the
+segments whose contents changed are tokenised again.
+
+segments start at the start of a line, and which lines they start at depends
+only on the contents of the line before (see _cut), not on where it is in the
+file. so inserting or deleting text only changes the segments around it, and
+the ones after it are the same as before but for where they start. segments
+are between SEGMENT_MIN and SEGMENT_MAX bytes long (about SEGMENT_SIZE on
+average), and each one goes on for SEGMENT_OVERLAP past the start of the
+next (to the start of a line, if there's one near) so that a word (or
+phrase) that straddles the boundary is whole in at least one of them. every
+byte of the file belongs to exactly one segment, the one that starts at or
+before it and is followed by one that starts after it. hits are only reported
+from the segment that they belong to, so the ones in an overlap aren't
+reported twice.
+"""
+
+import zlib
+
+SEGMENT_SIZE = 1024*1024
+SEGMENT_MIN = SEGMENT_SIZE // 2
+SEGMENT_MAX = SEGMENT_SIZE * 2
+SEGMENT_OVERLAP = 4*1024
+
+# a line ends a segment (once it's at least SEGMENT_MIN long) with a
+# probability of its length over CUT_SPACING, so that segments go on for about
+# CUT_SPACING bytes past SEGMENT_MIN however long their lines are
+CUT_SPACING = SEGMENT_SIZE - SEGMENT_MIN
+
+# the docid in files of the file that a row of files_fts (aliased as ft)
+# belongs to
+FILE_DOCID = """
+    CASE WHEN ft.docid < 0
+         THEN (SELECT s.docid FROM segments s WHERE s.segid = ft.docid)
+         ELSE ft.docid
+    END
+"""
+
+def _boundary(content, pos):
+    # the start of the first line at or after pos, if it's close enough
+    if pos <= 0 or pos >= len(content):
+        return min(max(pos, 0), len(content))
+    newline = str(content[pos-1:pos+SEGMENT_OVERLAP-1]).find('\n')
+    if newline == -1:
+        return pos
+    return pos + newline
+
+def _cut(line):
+    # whether a segment should end after this line
+    return zlib.crc32(line) & 0xffffffff < len(line) * (2**32 // CUT_SPACING)
+
+def _next_start(content, start):
+    # where the segment after the one that starts at start starts, or None if
+    # it's the last one
+    if len(content) - start <= SEGMENT_MIN:
+        return None
+
+    newline = content.find('\n', start + SEGMENT_MIN - 1, start + SEGMENT_MAX - 1)
+    while newline != -1:
+        line = content[content.rfind('\n', start, newline) + 1:newline + 1]
+        if _cut(line):
+            return newline + 1
+        newline = content.find('\n', newline + 1, start + SEGMENT_MAX - 1)
+
+    if len(content) - start <= SEGMENT_MAX:
+        return None
+    # no line wanted to end it, so end it at the last one that we can
+    newline = content.rfind('\n', start + SEGMENT_MIN - 1, start + SEGMENT_MAX - 1)
+    return newline + 1 if newline != -1 else start + SEGMENT_MAX
+
+def segment_bounds(content):
+    """
+    the (start, end) of each of the segments to index content as, or None if
+    it's small enough to be indexed in one piece
+    """
+    if len(content) <= SEGMENT_SIZE:
+        return None
+    # it may be a buffer
+    content = str(content)
+
+    bounds = []
+    start = 0
+    while True:
+        following = _next_start(content, start)
+        if following is None:
+            bounds.append((start, len(content)))
+            break
+        bounds.append((start, _boundary(content, following + SEGMENT_OVERLAP)))
+        start = following
+
+    if len(bounds) == 1:
+        # nothing wanted to end the first segment before the end
+        return None
+    return bounds
+
+def segmented(c):
+    """
+    whether any documents have been split into segments (if not, searches can
+    skip the work of putting them back together)
+    """
+    c.execute("SELECT 1 FROM segments LIMIT 1")
+    return c.fetchone() is not None
+
+def load_segments(c, docid):
+    """
+    the (segid, start, end) of each of the document's segments in order, where
+    end is where the next one starts (or None for the last one). that's a
+    single segment (docid, 0, None) if it isn't segmented
+    """
+    c.execute("SELECT segid, start FROM segments WHERE docid = ? ORDER BY start", (docid,))
+    rows = c.fetchall()
+    if not rows:
+        return [(docid, 0, None)]
+    return [(segid, start, rows[x+1][1] if x+1 < len(rows) else None)
+            for x, (segid, start) in enumerate(rows)]
+
+def owns(start, end, offset):
+    """
+    whether the segment from start to end is the one that reports a hit at
+    offset in the file
+    """
+    return start <= offset and (end is None or offset < end)
+
+def indexed_text(c, docid, begin, end=None):
+    """
+    the bytes of the indexed copy of the document from begin up to end (or its
+    end), put back together from its segments if need be
+    """
+    pieces = []
+    for segid, start, segend in load_segments(c, docid):
+        if segend is not None and segend <= begin:
+            continue
+        if end is not None and end <= start:
+            break
+
+        # offsets are in bytes, so treat the body as a blob (substr counts
+        # characters in text)
+        lo = max(begin, start)
+        limits = [x for x in (end, segend) if x is not None]
+        hi = min(limits) if limits else None
+        if hi is None:
+            c.execute("SELECT substr(CAST(body AS BLOB), ?) FROM files_fts WHERE docid = ?",
+                      (lo - start + 1, segid))
+        else:
+            c.execute("SELECT substr(CAST(body AS BLOB), ?, ?) FROM files_fts WHERE docid = ?",
+                      (lo - start + 1, hi - lo, segid))
+        row = c.fetchone()
+        if row is not None and row[0] is not None:
+            pieces.append(str(row[0]))
+    return ''.join(pieces)
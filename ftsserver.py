@@ -0,0 +1,214 @@
+"""
+a search server that keeps a warm connection to one .fts.db, so that
+repeated searches don't pay for starting up and opening the database.
+
+The protocol is line-delimited JSON over a unix socket at .fts.sock next to
+the .fts.db. The client sends one request per line:
+
+    {"prefix": "subdir", "terms": ["bacon", "eggs"], "mode": "MATCH",
+     "combine": "OR", "color": false, "scopes": null, "limit": null,
+     "offset": 0, "context": null, "filenames_only": false}
+
+and the server answers with one line per result:
+
+    {"filename": ..., "offsets": [[offset, length], ...], "snippet": ...,
+     "last_modified": ..., "lines": null}
+
+followed by {"done": true}, or {"error": "message"} if the search failed. A
+client may send any number of requests on the same connection. The results
+of recent searches are cached until the database changes (see ftscache).
+
+Our strings are bytes, so they're sent as latin-1 which round-trips any byte.
+"""
+
+import os
+import os.path
+import errno
+import socket
+import signal
+import threading
+import json
+import SocketServer
+
+from ftsdb import logger, opendb, _sock_name
+from ftssearch import search, SearchResult, StaleCheck
+from ftscache import ResultCache, CACHE_ENTRIES
+
+def sockname(root):
+    return os.path.join(root, _sock_name)
+
+def _encode(obj):
+    return json.dumps(obj, encoding='latin-1') + '\n'
+
+def _decode(line):
+    def bytestring(v):
+        if isinstance(v, unicode):
+            return v.encode('latin-1')
+        elif isinstance(v, list):
+            return map(bytestring, v)
+        return v
+    def bytestrings(d):
+        return dict((str(k), bytestring(v)) for k, v in d.iteritems())
+    return json.loads(line, object_hook=bytestrings)
+
+class NoServer(Exception):
+    pass
+
+class SearchHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+
+            try:
+                req = _decode(line)
+                mode = req.get('mode', 'MATCH')
+                if mode not in ('MATCH', 'REGEXP'):
+                    raise ValueError("unknown mode %r" % (mode,))
+                combine = req.get('combine', 'OR')
+                if combine not in ('AND', 'OR'):
+                    raise ValueError("unknown combine %r" % (combine,))
+
+                prefix = req.get('prefix', '')
+                terms = req['terms']
+                scopes = req.get('scopes')
+                limit = req.get('limit')
+                offset = req.get('offset', 0)
+                context = req.get('context')
+                color = req.get('color', False)
+                filenames_only = req.get('filenames_only', False)
+                key = (prefix, tuple(terms), mode, combine,
+                       tuple(scopes) if scopes is not None else None,
+                       limit, offset,
+                       tuple(context) if context is not None else None,
+                       color, filenames_only)
+
+                # the client checks whether the results are up to date, since
+                # it knows where it's running from
+                with self.server.lock:
+                    results = self.server.cache.search(
+                        key, lambda: search(self.server.conn, prefix, terms, mode,
+                                            combine=combine, scopes=scopes,
+                                            limit=limit, offset=offset,
+                                            context=context, checksync=False,
+                                            color=color, filenames_only=filenames_only))
+
+            except Exception as e:
+                logger.exception("Search failed for %r", line)
+                self.wfile.write(_encode(dict(error=str(e))))
+
+            else:
+                for sr in results:
+                    self.wfile.write(_encode(sr.to_json()))
+                self.wfile.write(_encode(dict(done=True)))
+
+            self.wfile.flush()
+
+class SearchServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, root, cache_size=CACHE_ENTRIES):
+        self.root = root
+        # searches are serialised on this one connection, which is what keeps
+        # it (and sqlite's page cache) warm
+        self.conn = opendb(root, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.cache = ResultCache(self.conn, entries=cache_size, check_same_thread=False)
+
+        fname = sockname(root)
+        if os.path.exists(fname):
+            if connect_client(root) is not None:
+                raise Exception("a server is already running on %s" % fname)
+            # left over from one that died
+            os.unlink(fname)
+
+        SocketServer.UnixStreamServer.__init__(self, fname, SearchHandler)
+
+    def server_close(self):
+        SocketServer.UnixStreamServer.server_close(self)
+        self.cache.close()
+        try:
+            os.unlink(sockname(self.root))
+        except OSError:
+            pass
+
+def serve(root, cache_size=CACHE_ENTRIES):
+    """
+    answer searches against the .fts.db in root until interrupted, caching
+    the results of up to cache_size of them
+    """
+    server = SearchServer(root, cache_size=cache_size)
+
+    def terminate(signum, frame):
+        raise SystemExit()
+    signal.signal(signal.SIGTERM, terminate)
+
+    logger.info("Serving searches on %s", sockname(root))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+class SearchClient(object):
+    def __init__(self, sock):
+        self.sock = sock
+        self.rfile = sock.makefile('rb')
+
+    def search(self, prefix, terms, mode, combine='OR', checksync=True, color=False,
+               scopes=None, limit=None, offset=0, context=None, filenames_only=False):
+        """
+        like ftssearch.search, but run by the server. raises NoServer if the
+        server goes away, which may be after some of the results
+        """
+        try:
+            self.sock.sendall(_encode(dict(prefix=prefix, terms=terms, mode=mode,
+                                           combine=combine, color=color, scopes=scopes,
+                                           limit=limit, offset=offset, context=context,
+                                           filenames_only=filenames_only)))
+        except socket.error as e:
+            raise NoServer("couldn't send the search: %s" % e)
+
+        check = StaleCheck() if checksync else None
+        while True:
+            try:
+                line = self.rfile.readline()
+            except socket.error:
+                line = None
+            if not line:
+                # the results that we did get are still checked
+                if check is not None:
+                    check.finish()
+                raise NoServer("it hung up")
+            resp = _decode(line)
+            if 'error' in resp:
+                raise Exception(resp['error'])
+            if resp.get('done'):
+                break
+
+            sr = SearchResult.from_json(resp)
+            if check is not None:
+                check.add(sr)
+            yield sr
+
+        if check is not None:
+            check.finish()
+
+    def close(self):
+        self.rfile.close()
+        self.sock.close()
+
+def connect_client(root):
+    """
+    return a SearchClient connected to the server for root, or None if there
+    isn't one running
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(sockname(root))
+    except socket.error as e:
+        sock.close()
+        if e.errno in (errno.ENOENT, errno.ECONNREFUSED):
+            return None
+        raise
+    return SearchClient(sock)
@@ -0,0 +1,140 @@
+"""
+keep binary and generated files out of the index.
+
+every file that the sync reads is sniffed before it's indexed. ones that look
+binary (a NUL byte or too many control characters or bytes that aren't utf-8
+in their first block) are always skipped, and so are ones over the optional
+limits on line length (minified or generated code) and on the entropy of the
+first block (compressed or encrypted data, embedded keys). a skipped file
+keeps its row in files, with a row in skipped saying why, but nothing in
+files_fts, so it's never returned by a search. a skipped file is sniffed again
+whenever it changes, but changing the limits doesn't affect files that have
+already been indexed until they do
+"""
+
+import math
+import re as pyre
+from collections import namedtuple
+
+from ftsdb import Cursor, getconfig, setconfig, with_shards, varints
+
+# how much of a file to look at for the binary and entropy checks
+SNIFF_BLOCK = 8*1024
+
+# the fraction of the first block that may be control characters or invalid
+# utf-8 before it's called binary
+MAX_ODD = 0.3
+
+# the longest line limit that python's re module can check for
+MAX_LINE_LIMIT = 65535
+
+# control characters that text files do have: \t \n \v \f \r and the escape
+# that starts terminal colour codes
+_CONTROL = ''.join(chr(x) for x in range(32) + [127]
+                   if chr(x) not in '\t\n\v\f\r\x1b')
+
+# zeroes turn a limit off
+Limits = namedtuple('Limits', ('max_line_length', 'max_entropy'))
+
+def load_limits(c):
+    return Limits(int(getconfig(c, 'max_line_length', 0)),
+                  float(getconfig(c, 'max_entropy', 0)))
+
+def set_limits(conn, max_line_length=None, max_entropy=None):
+    with Cursor(conn) as c:
+        if max_line_length is not None:
+            setconfig(c, 'max_line_length', min(max_line_length, MAX_LINE_LIMIT))
+        if max_entropy is not None:
+            setconfig(c, 'max_entropy', max_entropy)
+
+def entropy(block):
+    # in bits per byte
+    if not block:
+        return 0.0
+    total = float(len(block))
+    bits = 0.0
+    for x in xrange(256):
+        n = block.count(chr(x))
+        if n:
+            p = n / total
+            bits -= p * math.log(p, 2)
+    return bits
+
+def sniff(content, limits=None):
+    """
+    the reason to skip a document with these contents, or None to index it.
+    this is run on the reader threads, so it must not touch the database
+    """
+    block = str(buffer(content, 0, SNIFF_BLOCK))
+
+    if '\0' in block:
+        return 'binary'
+    odd = len(block) - len(block.translate(None, _CONTROL))
+    odd += block.decode('utf-8', 'replace').count(u'\ufffd')
+    if odd > len(block) * MAX_ODD:
+        return 'binary'
+
+    if limits is None:
+        return None
+
+    if limits.max_entropy and entropy(block) > limits.max_entropy:
+        return 'high entropy'
+
+    if limits.max_line_length:
+        longer = pyre.compile(r'(?m)^[^\n]{%d}' % (min(limits.max_line_length, MAX_LINE_LIMIT) + 1))
+        if longer.search(content):
+            return 'long lines'
+
+    return None
+
+def _index_ratio(c):
+    # how many bytes of files_fts (its copy of the text and its index) there
+    # are for each byte of the documents that are in it
+    c.execute("SELECT value FROM files_fts_stat WHERE id = 0")
+    row = c.fetchone()
+    indexed = varints(row[0])[-1] if row else 0
+    if not indexed:
+        return 0.0
+    c.execute("""
+        SELECT (SELECT COALESCE(SUM(length(c0body)), 0) FROM files_fts_content)
+             + (SELECT COALESCE(SUM(length(block)), 0) FROM files_fts_segments)
+             + (SELECT COALESCE(SUM(length(root)), 0) FROM files_fts_segdir)
+    """)
+    return float(c.fetchone()[0]) / indexed
+
+def skipped_report(conn):
+    """
+    print the skipped files and how much they'd have added to the index
+    """
+    reasons = {} # reason -> [files, bytes, estimated index bytes]
+    for db in with_shards(conn):
+        with Cursor(db) as c:
+            ratio = _index_ratio(c)
+            c.execute("""
+                SELECT f.path, s.reason, s.size
+                  FROM skipped s, files f
+                 WHERE s.docid = f.docid
+              ORDER BY f.path
+            """)
+            for path, reason, size in c.fetchall():
+                print '\t'.join((path, reason, str(size)))
+                entry = reasons.setdefault(reason, [0, 0, 0.0])
+                entry[0] += 1
+                entry[1] += size
+                entry[2] += size * ratio
+
+    if not reasons:
+        print "no files were skipped"
+        return
+
+    print
+    for reason, (files, size, saved) in sorted(reasons.iteritems()):
+        print "%s: %d files, %s" % (reason, files, _human(size))
+    print "about %s of index avoided" % _human(sum(saved for files, size, saved in reasons.values()))
+
+def _human(n):
+    for unit in ('bytes', 'KiB', 'MiB', 'GiB'):
+        if n < 1024 or unit == 'GiB':
+            break
+        n /= 1024.0
+    return ('%d %s' if unit == 'bytes' else '%.1f %s') % (n, unit)
@@ -0,0 +1,145 @@
+"""
+counters and timers for --stats.
+
+everything is collected on the module-level stats object, which does nothing
+until it's enabled:
+
+    with stats.phase('walk'):
+        ...
+        stats.count('stat calls')
+
+phases nest, so a 'walk' inside of a 'sync' is reported as 'sync.walk'. a
+thread's phases nest under the phase that started it if it's handed where()
+and runs in within(), and their times are summed over the threads. the
+Cursor wrapper in ftsdb times every SQL statement that goes through it
+(including fetching its rows with fetchone/fetchmany/fetchall, but not by
+iterating over the cursor)
+"""
+
+import sys
+import json
+import time
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict
+
+# how many of the slowest statements to list
+SQL_REPORT = 20
+
+@contextmanager
+def _nothing():
+    yield
+
+class Stats(object):
+    def __init__(self):
+        self.enabled = False
+        self.started = time.time()
+        self.phases = OrderedDict() # name -> [seconds, calls], in the order they started
+        self.counters = {} # name -> count
+        self.sql = {} # statement -> [seconds, calls]
+        # the sync's threads count and time things too
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    @property
+    def stack(self):
+        # the phases that this thread is in
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    def enable(self):
+        self.enabled = True
+        self.started = time.time()
+
+    def phase(self, name):
+        if not self.enabled:
+            return _nothing()
+        return self._phase(name)
+
+    @contextmanager
+    def _phase(self, name):
+        self.stack.append(name)
+        with self.lock:
+            entry = self.phases.setdefault('.'.join(self.stack), [0.0, 0])
+        start = time.time()
+        try:
+            yield
+        finally:
+            with self.lock:
+                entry[0] += time.time() - start
+                entry[1] += 1
+            self.stack.pop()
+
+    def where(self):
+        return list(self.stack)
+
+    @contextmanager
+    def within(self, where):
+        self.local.stack = list(where)
+        try:
+            yield
+        finally:
+            self.local.stack = []
+
+    def count(self, name, n=1):
+        if self.enabled:
+            with self.lock:
+                self.counters[name] = self.counters.get(name, 0) + n
+
+    def sql_time(self, stmt, took, calls=1):
+        key = ' '.join(stmt.split())
+        with self.lock:
+            entry = self.sql.setdefault(key, [0.0, 0])
+            entry[0] += took
+            entry[1] += calls
+
+    def counted(self, name, fn):
+        """
+        wrap fn (e.g. a function that sqlite calls for every row) so that its
+        calls are counted
+        """
+        counter = '%s calls' % name
+        def wrapper(*a):
+            self.count(counter)
+            return fn(*a)
+        return wrapper
+
+    def to_json(self):
+        return dict(
+            seconds=round(time.time() - self.started, 6),
+            phases=dict((name, dict(seconds=round(seconds, 6), calls=calls))
+                        for name, (seconds, calls) in self.phases.iteritems()),
+            counters=dict(self.counters),
+            sql=[dict(statement=stmt, seconds=round(seconds, 6), calls=calls)
+                 for stmt, (seconds, calls) in sorted(self.sql.iteritems(),
+                                                      key=lambda x: -x[1][0])])
+
+    def report(self, fmt='text', out=None):
+        out = out or sys.stderr
+        if fmt == 'json':
+            json.dump(self.to_json(), out, indent=2, sort_keys=True)
+            out.write('\n')
+            return
+
+        out.write("%.3fs total\n" % (time.time() - self.started))
+        if self.phases:
+            out.write("\n%-40s %10s %8s\n" % ('phase', 'seconds', 'calls'))
+            for name, (seconds, calls) in self.phases.iteritems():
+                indent = '  ' * name.count('.')
+                out.write("%-40s %10.3f %8d\n" % (indent + name.split('.')[-1], seconds, calls))
+        if self.counters:
+            out.write("\n%-40s %10s\n" % ('counter', 'count'))
+            for name, count in sorted(self.counters.iteritems()):
+                out.write("%-40s %10d\n" % (name, count))
+        if self.sql:
+            out.write("\n%10s %8s  %s\n" % ('seconds', 'calls', 'statement'))
+            slowest = sorted(self.sql.iteritems(), key=lambda x: -x[1][0])
+            for stmt, (seconds, calls) in slowest[:SQL_REPORT]:
+                if len(stmt) > 100:
+                    stmt = stmt[:97] + '...'
+                out.write("%10.3f %8d  %s\n" % (seconds, calls, stmt))
+            if len(slowest) > SQL_REPORT:
+                out.write("(and %d more statements)\n" % (len(slowest) - SQL_REPORT))
+
+stats = Stats()
@@ -1,69 +1,261 @@
 import os
+import sys
 import contextlib
 import os.path
 import errno
 import stat
 import time
 import mmap
-from functools import partial
+from operator import itemgetter
 import logging
-import fnmatch
-
-from ftsdb import re # re or re2
-
-from ftsdb import update_document, add_document, remove_document
-from ftsdb import prefix_expr, logger, Cursor
-
-# nly index the first N bytes of a file
-MAX_FSIZE = 1024*1024
+import threading
+import Queue
+import hashlib
+from collections import namedtuple
+
+from ftsdb import update_document, add_document, add_documents, remove_document
+from ftsdb import touch_document, move_document, add_skipped, skip_document
+from ftsdb import bulkload, create_path_index
+from ftsdb import prefix_clauses, logger, Cursor
+from ftsdb import openfile, shard_files, shard_of
+from ftsexclude import load_exclusions
+from ftstrigrams import trigrams, trigrams_enabled
+from ftslines import line_starts
+from ftssegments import segment_bounds
+from ftssniff import sniff, load_limits
+from ftsstats import stats
+
+# only index the first N bytes of a file. files bigger than
+# ftssegments.SEGMENT_SIZE are indexed in segments
+MAX_FSIZE = 256*1024*1024
+
+# when there are at least this many new files to add, switch to the bulk loading
+# path, which adds them BULK_BATCH at a time (or BULK_BATCH_BYTES of content,
+# whichever comes first)
+BULK_THRESHOLD = 1000
+BULK_BATCH = 500
+BULK_BATCH_BYTES = 16*1024*1024
+
+# commit after this many documents or seconds, whichever comes first, so that
+# searches can see our progress and an interrupted sync doesn't lose it
+SYNC_CHUNK = 1000
+SYNC_CHUNK_SECONDS = 5
+
+# directories modified less than this many seconds before a sync started
+# aren't trusted on the next one, since they may have changed again within the
+# resolution of their mtime
+RACY_WINDOW = 2
+
+# how many prepared documents each reader thread may have waiting for the
+# writer before it blocks
+PREFETCH_DEPTH = 8
+
+# and how many bytes of files all of the reader threads in the process (every
+# shard's included) may have read that the writers haven't got to yet. the
+# prepared documents take a few times that in memory
+PREFETCH_BYTES = 64*1024*1024
+
+class ByteBudget(object):
+    """
+    a semaphore counted in bytes. a single acquire that's bigger than the limit
+    is allowed when nothing else is held, so that big files can still be read
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        self.held = 0
+        self.cond = threading.Condition()
+
+    def acquire(self, n, stop):
+        # returns False without acquiring anything if stop is set while we wait
+        with self.cond:
+            while self.held and self.held + n > self.limit:
+                if stop.is_set():
+                    return False
+                self.cond.wait(1)
+            self.held += n
+            return True
+
+    def release(self, n):
+        with self.cond:
+            self.held -= n
+            self.cond.notify_all()
+
+prefetched = ByteBudget(PREFETCH_BYTES)
 
 @contextlib.contextmanager
 def get_bytes(fname, size):
     """
     yield a python Buffer mapping to the first MAX_FSIZE bytes of the given file
     """
-    size = min(size, MAX_FSIZE)
+    if size > MAX_FSIZE:
+        logger.warning("Only indexing the first %dMiB of %s, which is %.1fMiB",
+                       MAX_FSIZE // (1024*1024), fname, size / (1024.0*1024))
+        stats.count('files truncated')
+        size = MAX_FSIZE
 
     if size == 0:
         yield ''
         return
 
+    stats.count('files read')
+    stats.count('bytes read', size)
+
     # try to save some memory by using the OS buffers instead of copying
     # the file contents
     with open(fname, 'rb') as f:
         with contextlib.closing(mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)) as mm:
             yield buffer(mm, 0, size)
 
-def should_allow(exclusions, basename, dbpath):
+# for a big document, content, trigrams and lines are its first segment's and
+# segments is a list of PreparedSegments for all of them (see ftssegments).
+# digest is always the whole document's. skipped is the reason that ftssniff
+# gave for leaving it out of the index, in which case there's nothing else
+PreparedDocument = namedtuple('PreparedDocument', ('content', 'digest', 'trigrams', 'lines', 'segments', 'skipped'))
+PreparedSegment = namedtuple('PreparedSegment', ('start', 'content', 'digest', 'trigrams', 'lines'))
+
+def prepare_document(content, with_trigrams=False, limits=None):
     """
-    returns whether a given file should be allowed to exist based on our
-    exclusion list
+    work out everything about a document that we can without the database. this
+    is run on the reader threads, so it must not touch the database
     """
-    # exclusions =:= [{type, pattern}]
-
-    for typ, pattern in exclusions:
-        if typ == 'simple':
-            if basename == pattern:
-                return False
+    digest = hashlib.sha1(content).hexdigest()
+
+    reason = sniff(content, limits)
+    if reason is not None:
+        return PreparedDocument(None, digest, None, None, None, reason)
+
+    bounds = segment_bounds(content)
+    if bounds is None:
+        return PreparedDocument(content,
+                                digest,
+                                trigrams(content) if with_trigrams else None,
+                                line_starts(content),
+                                None,
+                                None)
+
+    segments = []
+    for x, (start, end) in enumerate(bounds):
+        segment = buffer(content, start, end - start)
+        segments.append(PreparedSegment(start,
+                                        segment,
+                                        hashlib.sha1(segment).hexdigest(),
+                                        trigrams(segment) if with_trigrams else None,
+                                        line_starts(segment, last=x == len(bounds)-1)))
+    first = segments[0]
+    return PreparedDocument(first.content, digest, first.trigrams, first.lines, segments, None)
+
+def read_document(fname, size, with_trigrams=False, limits=None):
+    """
+    read the indexable contents of the given file into memory and prepare them
+    """
+    with get_bytes(fname, size) as bb:
+        return prepare_document(str(bb), with_trigrams, limits)
 
-        elif typ == 'glob':
-            # on basename only?
-            if fnmatch.fnmatch(basename, pattern):
-                return False
+def prepare_documents(rows, locate, jobs=1, with_trigrams=False, limits=None):
+    """
+    yield (row, PreparedDocument, error) for every row in rows. locate(row) must return
+    the (fname, size) to read. with jobs > 1 the files are read on that many
+    threads ahead of the caller, who remains the only one to write to the
+    database. results may then be returned out of order
+    """
+    if jobs <= 1:
+        for row in rows:
+            fname, size = locate(row)
+            try:
+                with get_bytes(fname, size) as bb:
+                    yield row, prepare_document(bb, with_trigrams, limits), None
+            except IOError as e:
+                yield row, None, e
+        return
 
-        elif typ == 're':
-            if pattern.search(dbpath):
-                # match or search? basename or full path or dbpath?
-                return False
+    todo = Queue.Queue()
+    # bounded (and so is the number of bytes that the readers may hold, by
+    # prefetched) so that a slow writer doesn't make us read the whole tree
+    # into memory
+    done = Queue.Queue(maxsize=jobs*PREFETCH_DEPTH)
+    stop = threading.Event()
+
+    def reader():
+        while not stop.is_set():
+            row = todo.get()
+            if row is None:
+                return
+            fname, size = locate(row)
+            cost = min(size, MAX_FSIZE)
+            if not prefetched.acquire(cost, stop):
+                return
+            try:
+                done.put((row, read_document(fname, size, with_trigrams, limits), None, cost))
+            except Exception as e:
+                # hand it to the writer to deal with rather than dying and
+                # leaving it waiting on us forever
+                done.put((row, None, e, cost))
+
+    threads = [threading.Thread(target=reader, name='fts-reader-%d' % x)
+               for x in xrange(jobs)]
+    for t in threads:
+        t.daemon = True
+        t.start()
+
+    def get():
+        # a Queue.get() without a timeout can't be interrupted with ^C
+        while True:
+            try:
+                return done.get(True, 1)
+            except Queue.Empty:
+                pass
 
-    return True
+    def drain():
+        while True:
+            try:
+                row, doc, e, cost = done.get_nowait()
+            except Queue.Empty:
+                return
+            prefetched.release(cost)
+
+    try:
+        inflight = 0
+        for row in rows:
+            todo.put(row)
+            inflight += 1
+            while inflight >= done.maxsize:
+                row, doc, e, cost = get()
+                inflight -= 1
+                try:
+                    yield row, doc, e
+                finally:
+                    prefetched.release(cost)
+        while inflight:
+            row, doc, e, cost = get()
+            inflight -= 1
+            try:
+                yield row, doc, e
+            finally:
+                prefetched.release(cost)
+
+    finally:
+        # we may be here early because the caller gave up on us, so the
+        # readers may be blocked on a full queue or waiting for bytes
+        stop.set()
+        for t in threads:
+            todo.put(None)
+        for t in threads:
+            while t.is_alive():
+                drain()
+                t.join(0.01)
+        drain()
 
 def visitor(path, prefix, exclusions, cu, dirname, fnames):
+    """
+    add the files in dirname to ondisk and return the subdirectories that we
+    should walk into
+    """
     if logger.getEffectiveLevel() <= logging.DEBUG:
         logger.debug("Walking %s", dirname)
         fnames.sort() # makes the child 'walking' messages come out in an order the user expects
 
     remove = []
+    subdirs = []
 
     for basename in fnames:
         fname = os.path.join(dirname, basename)
@@ -74,124 +266,403 @@ def visitor(path, prefix, exclusions, cu, dirname, fnames):
 
         dbfname = fname[len(path)+1:]
 
-        if exclusions and not should_allow(exclusions, basename, dbfname):
+        if exclusions and not exclusions.allow(basename, dbfname):
             remove.append(basename)
             continue
 
         try:
             st = os.stat(fname)
+            stats.count('stat calls')
             mode = st.st_mode
             size = st[stat.ST_SIZE]
             if stat.S_ISDIR(mode):
+                if exclusions and not exclusions.allow_dir(basename, dbfname):
+                    remove.append(basename)
+                # like os.path.walk, don't follow symlinks to directories
+                elif not os.path.islink(fname):
+                    subdirs.append(fname)
                 continue
             if not stat.S_ISREG(mode):
                 logger.warn("Skipping non-regular file %s (%s)", dbfname, stat.S_IFMT(mode))
                 continue
-        except IOError as e:
+        except OSError as e:
             if e.errno == errno.ENOENT:
                 # it was deleted in between
                 continue
             raise
 
-        cu.execute("INSERT INTO ondisk(path, dbpath, last_modified, size) VALUES (?, ?, ?, ?)",
+        # OR REPLACE because sync_paths may be asked for the same file twice
+        cu.execute("INSERT OR REPLACE INTO ondisk(path, dbpath, last_modified, size) VALUES (?, ?, ?, ?)",
                    (fname, dbfname, int(st[stat.ST_MTIME]), size))
 
     if remove and logger.getEffectiveLevel() <= logging.DEBUG:
         logger.debug("Removing %r from walk", list(remove))
-    for r in remove:
-        fnames.remove(r)
+
+    return subdirs
+
+def walk(path, prefix, exclusions, cu, trust_dirs=False, started=None):
+    """
+    walk the tree under path/prefix, adding the files that might need syncing
+    to ondisk and every directory that we saw to ondiskdirs.
+
+    With trust_dirs, a directory whose mtime and inode are the same as they
+    were on the last sync is trusted to have the same entries, so we don't
+    list it again or stat() its files. That means that files that were
+    modified in place (without being replaced) in such a directory will be
+    missed, so it's only done when asked for. Its subdirectories are still
+    checked.
+    """
+    if started is None:
+        started = time.time()
+
+    wpath = path
+    if prefix:
+        wpath = os.path.join(path, prefix)
+
+    stack = [wpath]
+    while stack:
+        dirname = stack.pop()
+        dbdir = dirname[len(path)+1:]
+        parent = os.path.dirname(dbdir) if dbdir else None
+
+        try:
+            st = os.stat(dirname)
+            stats.count('stat calls')
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                continue
+            raise
+        mtime, inode = st.st_mtime, st.st_ino
+
+        if trust_dirs:
+            cu.execute("SELECT last_modified, inode FROM dirs WHERE path = ?", (dbdir,))
+            if cu.fetchone() == (mtime, inode):
+                logger.debug("Skipping unchanged %s", dirname)
+                cu.execute("""INSERT OR REPLACE INTO ondiskdirs(path, parent, last_modified, inode, unchanged)
+                              VALUES(?, ?, ?, ?, 1)""",
+                           (dbdir, parent, mtime, inode))
+                cu.execute("SELECT path FROM dirs WHERE parent = ?", (dbdir,))
+                stack.extend(os.path.join(path, subdir) for (subdir,) in cu.fetchall())
+                continue
+
+        if mtime >= started - RACY_WINDOW:
+            # it may still change again without its mtime moving, so we can't
+            # trust it next time
+            mtime = None
+
+        cu.execute("""INSERT OR REPLACE INTO ondiskdirs(path, parent, last_modified, inode, unchanged)
+                      VALUES(?, ?, ?, ?, 0)""",
+                   (dbdir, parent, mtime, inode))
+
+        try:
+            fnames = os.listdir(dirname)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                continue
+            raise
+
+        subdirs = visitor(path, prefix, exclusions, cu, dirname, fnames)
+        # reversed so that we visit them in the order that visitor saw them
+        stack.extend(reversed(subdirs))
+
+class Chunker(object):
+    """
+    commits the sync's work every SYNC_CHUNK documents or SYNC_CHUNK_SECONDS
+    """
+    def __init__(self, conn):
+        self.conn = conn
+        self.count = 0
+        self.started = time.time()
+
+    def done(self, n=1):
+        self.count += n
+        if self.count >= SYNC_CHUNK or time.time() - self.started >= SYNC_CHUNK_SECONDS:
+            self.conn.commit()
+            self.count = 0
+            self.started = time.time()
+
+def paged(c, query, page=SYNC_CHUNK):
+    """
+    yield the rows of query a page at a time. query must select a unique
+    positive integer key first and take two parameters, returning the rows
+    whose key is greater than the first in order of their keys and LIMITed to
+    the second. pages are fetched in full because committing resets any
+    cursors that are still reading
+    """
+    last = 0
+    while True:
+        rows = c.execute(query, (last, page)).fetchall()
+        if not rows:
+            return
+        for row in rows:
+            yield row
+        last = rows[-1][0]
 
 def tcount(c, tname):
     return c.execute("SELECT COUNT(*) FROM %s;" % tname).fetchone()[0]
 
-def sync(conn, path, prefix, files = None):
+def sync(conn, path, prefix, files = None, jobs = 1, trust_dirs = False):
     # path must be a full path on disk
     # prefix must be the full path on disk that we're syncing (or empty)
+    # jobs is the number of threads to read files on
+    # trust_dirs means to skip directories whose mtimes haven't changed
+    # instead of stat()ing every file
+
+    def collect(cu, exclusions, start):
+        if files is None:
+            walk(path, prefix, exclusions, cu, trust_dirs=trust_dirs, started=start)
+        else:
+            wpath = path
+            if prefix:
+                wpath = os.path.join(path, prefix)
+            visitor(path, prefix, exclusions, cu, wpath, files)
+
+    # when we're given files, we don't know about anything else in the
+    # directory so we can't delete anything
+    scope = [prefix] if files is None else None
+
+    with stats.phase('sync'):
+        _sync(conn, path, collect, scope, jobs)
+
+def sync_paths(conn, path, dbpaths, jobs = 1):
+    """
+    sync only the given paths, relative to path. they may be files or
+    directories (in which case everything under them is synced) and they may
+    no longer exist, in which case they're deleted from the index
+    """
+    def collect(cu, exclusions, start):
+        bydir = {}
+        for dbpath in dbpaths:
+            dbdir, basename = os.path.split(dbpath)
+            bydir.setdefault(dbdir, []).append(basename)
+
+        for dbdir, basenames in sorted(bydir.iteritems()):
+            if exclusions and not exclusions.allow_path(dbdir):
+                continue
+            dirname = os.path.join(path, dbdir) if dbdir else path
+            for subdir in visitor(path, '', exclusions, cu, dirname, basenames):
+                walk(path, subdir[len(path)+1:], exclusions, cu, started=start)
+
+        # we were told that these changed, and mtimes only have whole seconds,
+        # so a file modified twice in a second (like by a watched editor)
+        # wouldn't look it. check them anyway, and the hash tells us if not
+        cu.executemany("UPDATE ondisk SET recheck = 1 WHERE dbpath = ?",
+                       ((dbpath,) for dbpath in dbpaths))
+
+    with stats.phase('sync'):
+        _sync(conn, path, collect, dbpaths, jobs)
+
+def _create_ondisk(c):
+    c.execute("""
+              CREATE TEMPORARY TABLE
+              ondisk (
+                 path          TEXT PRIMARY KEY COLLATE BINARY,
+                 dbpath        TEXT COLLATE BINARY,
+                 last_modified INTEGER,
+                 size          INTEGER,
+                 recheck       INTEGER NOT NULL DEFAULT 0
+              );
+              """)
+    c.execute("""
+              CREATE TEMPORARY TABLE
+              ondiskdirs (
+                 path          TEXT PRIMARY KEY COLLATE BINARY,
+                 parent        TEXT COLLATE BINARY,
+                 last_modified REAL,
+                 inode         INTEGER,
+                 unchanged     INTEGER NOT NULL
+              );
+              """)
+
+def _drop_ondisk(c):
+    c.execute("DROP TABLE ondisk;")
+    c.execute("DROP TABLE ondiskdirs;")
+
+def _sync(conn, path, collect, scope, jobs):
+    # collect(cu, exclusions, start) must fill in ondisk and ondiskdirs with
+    # what's on disk. scope is the list of paths (relative to path) whose
+    # subtrees collect looked at completely, so that anything under them that
+    # it didn't find can be deleted. '' means everything
 
     start = time.time()
 
+    with Cursor(conn) as c, Cursor(conn) as cu:
+        _create_ondisk(c)
+
+        exclusions = load_exclusions(c)
+        with_trigrams = trigrams_enabled(c)
+        limits = load_limits(c)
+
+        with stats.phase('walk'):
+            collect(cu, exclusions, start)
+
+        shards = shard_files(c)
+        if shards:
+            with stats.phase('shards'):
+                counts = _sync_shards(c, shards, scope, jobs, with_trigrams, limits)
+        else:
+            counts = _sync_documents(conn, scope, jobs, with_trigrams, limits)
+
+        news, moves, deletes, updates, touches, skips = counts
+        logger.info("%d new documents, %d moved, %d deletes, %d updates (%d unchanged, %d skipped) in %.2fs",
+                    news, moves, deletes, updates, touches, skips, time.time()-start)
+
+        with stats.phase('dirs'):
+            if scope is not None:
+                # now that everything under them is in sync, remember the
+                # directories for next time
+                for inscope, params in prefix_clauses('path', scope, include_self=True):
+                    cu.execute("""
+                        DELETE FROM dirs
+                         WHERE %s
+                           AND path NOT IN (SELECT path FROM ondiskdirs)
+                    """ % inscope, params)
+                cu.execute("""
+                    INSERT OR REPLACE INTO dirs(path, parent, last_modified, inode)
+                    SELECT path, parent, last_modified, inode FROM ondiskdirs
+                """)
+
+        _drop_ondisk(cu)
+
+def _sync_shards(c, shards, scope, jobs, with_trigrams, limits):
+    """
+    sync each of the shards on its own thread, from what the walk put in our
+    ondisk tables. returns the sums of _sync_documents' counts
+    """
+    # each shard gets a copy of the files that hash to it. the deletes only
+    # need to know which directories were skipped
+    files = [[] for fname in shards]
+    for row in c.execute("SELECT path, dbpath, last_modified, size, recheck FROM ondisk"):
+        files[shard_of(row[1], len(shards))].append(row)
+    unchanged = c.execute("""
+        SELECT path, parent, last_modified, inode, unchanged
+          FROM ondiskdirs
+         WHERE unchanged
+    """).fetchall()
+
+    counts = [None] * len(shards)
+    errors = []
+    where = stats.where()
+
+    def syncshard(x):
+        try:
+            sconn = openfile(shards[x])
+            try:
+                with stats.within(where), sconn, Cursor(sconn) as sc:
+                    _create_ondisk(sc)
+                    sc.executemany("""INSERT INTO ondisk(path, dbpath, last_modified, size, recheck)
+                                      VALUES(?, ?, ?, ?, ?)""",
+                                   files[x])
+                    sc.executemany("""INSERT INTO ondiskdirs(path, parent, last_modified, inode, unchanged)
+                                      VALUES(?, ?, ?, ?, ?)""",
+                                   unchanged)
+                    counts[x] = _sync_documents(sconn, scope, jobs, with_trigrams, limits)
+                    _drop_ondisk(sc)
+            finally:
+                sconn.close()
+        except:
+            errors.append(sys.exc_info())
+
+    threads = [threading.Thread(target=syncshard, args=(x,), name='fts-shard-%d' % x)
+               for x in xrange(len(shards))]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        # a join() without a timeout can't be interrupted with ^C
+        while t.is_alive():
+            t.join(1)
+
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+
+    return tuple(sum(n) for n in zip(*counts))
+
+def _sync_documents(conn, scope, jobs, with_trigrams, limits):
+    """
+    bring the documents in conn's database up to date with its ondisk tables.
+    returns how many were (new, moved, deleted, updated, unchanged, skipped)
+    """
     news = updates = deletes = 0
+    moves = touches = skips = 0
     tnews = tupdates = tdeletes = 0 # for debug printing
 
     with Cursor(conn) as c, Cursor(conn) as cu:
-        c.execute("""
-                  CREATE TEMPORARY TABLE
-                  ondisk (
-                     path          TEXT PRIMARY KEY COLLATE BINARY,
-                     dbpath        TEXT COLLATE BINARY,
-                     last_modified INTEGER,
-                     size          INTEGER
-                  );
-                  """)
-
-        exclusions = []
-        c.execute("SELECT type AS typ, expression AS e FROM exclusions;")
-        for typ, expression in c:
-            if typ == 're':
-                expression = re.compile(expression)
-            exclusions.append((typ, expression))
-
-        wpath = path
-        if prefix:
-            wpath = os.path.join(path, prefix)
-
-        if files is None:
-            os.path.walk(wpath, partial(visitor, path, prefix, exclusions), cu)
-        else:
-            visitor(path, prefix, exclusions, cu, wpath, files)
+        # an interrupted bulk load may have left us without it
+        create_path_index(c)
 
-        logger.debug("Creating temporary index on ondisk(dbpath)")
-        c.execute("CREATE INDEX tmp_ondisk_dbpath_idx ON ondisk(dbpath)")
+        with stats.phase('index'):
+            logger.debug("Creating temporary index on ondisk(dbpath)")
+            c.execute("CREATE INDEX tmp_ondisk_dbpath_idx ON ondisk(dbpath)")
 
         if logger.getEffectiveLevel() <= logging.DEBUG:
             logger.debug("Found %d files on disk", tcount(cu, "ondisk"))
 
-        # now build three groups: new files to be added, missing files to be
-        # deleted, and old files to be updated
-
-        # updated ones
-        cu.execute("""
-            CREATE TEMPORARY VIEW updated_files AS
-            SELECT f.docid AS docid,
-                   od.path AS path,
-                   od.last_modified AS last_modified,
-                   od.size AS size
-              FROM ondisk od, files f
-             WHERE od.dbpath = f.path
-               AND f.last_modified < od.last_modified
-        """)
-        if logger.getEffectiveLevel() <= logging.DEBUG:
-            tupdates = tcount(cu, "updated_files")
-            logger.debug("Prepared %d files for updating", tupdates)
-
-        # new files to create
-        cu.execute("""
-            CREATE TEMPORARY VIEW created_files AS
-            SELECT od.path AS path,
-                   od.dbpath AS dbpath,
-                   od.last_modified,
-                   od.size AS size
-              FROM ondisk od
-             WHERE NOT EXISTS(SELECT 1 FROM files f1 WHERE od.dbpath = f1.path)
-        """)
-        if logger.getEffectiveLevel() <= logging.DEBUG:
-            tnews = tcount(cu, "created_files")
-            logger.debug("Prepared %d files for creation", tnews)
+        with stats.phase('diff'):
+            # now build three groups: new files to be added, missing files to be
+            # deleted, and old files to be updated
 
-        # files that we've indexed in the past but don't exist anymore
-        if files is None:
-            # has to be a table instead of a view because parameters aren't allowed in views
+            # updated ones
             cu.execute("""
-                CREATE TEMPORARY TABLE deletedocs AS
-                SELECT f.docid AS docid,
-                       f.path AS path
-                  FROM files f
-                 WHERE (? = '' OR f.path LIKE ? ESCAPE '\\') -- ESCAPE disables the LIKE optimization :(
-                   AND NOT EXISTS(SELECT 1 FROM ondisk od WHERE od.dbpath = f.path)
-            """, (prefix, prefix_expr(prefix)))
+                CREATE TEMPORARY VIEW updated_files AS
+                SELECT od.rowid AS odid,
+                       f.docid AS docid,
+                       od.path AS path,
+                       od.last_modified AS last_modified,
+                       od.size AS size,
+                       f.hash AS hash
+                  FROM ondisk od, files f
+                 WHERE od.dbpath = f.path
+                   AND (f.last_modified < od.last_modified OR od.recheck)
+            """)
             if logger.getEffectiveLevel() <= logging.DEBUG:
-                tdeletes = tcount(cu, "deletedocs")
-                logger.debug("Prepared %d files for deletion", tdeletes)
+                tupdates = tcount(cu, "updated_files")
+                logger.debug("Prepared %d files for updating", tupdates)
+
+            # new files to create. this has to be a table instead of a view because
+            # a bulk load drops the index on files(path) that it relies on
+            cu.execute("""
+                CREATE TEMPORARY TABLE createdocs AS
+                SELECT od.path AS path,
+                       od.dbpath AS dbpath,
+                       od.last_modified,
+                       od.size AS size
+                  FROM ondisk od
+                 WHERE NOT EXISTS(SELECT 1 FROM files f1 WHERE od.dbpath = f1.path)
+            """)
+            tnews = tcount(cu, "createdocs")
+            logger.debug("Prepared %d files for creation", tnews)
+
+            # files that we've indexed in the past but don't exist anymore
+            if scope is not None:
+                # has to be a table instead of a view because parameters aren't allowed in views
+                cu.execute("""
+                    CREATE TEMPORARY TABLE
+                    deletedocs (
+                        docid INTEGER PRIMARY KEY,
+                        path  TEXT,
+                        hash  TEXT
+                    );
+                """)
+                # a file may be in more than one chunk's scope
+                for inscope, params in prefix_clauses('f.path', scope, include_self=True):
+                    cu.execute("""
+                        INSERT OR IGNORE INTO deletedocs(docid, path, hash)
+                        SELECT f.docid, f.path, f.hash
+                          FROM files f
+                         WHERE %s
+                           AND NOT EXISTS(SELECT 1 FROM ondisk od WHERE od.dbpath = f.path)
+                           -- files in unchanged directories aren't in ondisk, but they're
+                           -- still there. the rtrims get the directory part of the path
+                           AND NOT EXISTS(SELECT 1 FROM ondiskdirs d
+                                           WHERE d.path = rtrim(rtrim(f.path, replace(f.path, '/', '')), '/')
+                                             AND d.unchanged)
+                    """ % inscope, params)
+                # so that new files can find deleted ones with the same contents
+                cu.execute("CREATE INDEX tmp_deletedocs_hash_idx ON deletedocs(hash)")
+                if logger.getEffectiveLevel() <= logging.DEBUG:
+                    tdeletes = tcount(cu, "deletedocs")
+                    logger.debug("Prepared %d files for deletion", tdeletes)
 
         # set up our debugging progress-printing closure
         def printprogress(*a):
@@ -200,54 +671,166 @@ def sync(conn, path, prefix, files = None):
             progresstotal = tnews + tupdates + tdeletes
             if progresstotal > 0:
                 def printprogress(s, fname):
-                    total = updates+news+deletes
+                    total = updates+news+moves+deletes
                     percent = float(total)/progresstotal*100
                     logger.info("%d/%d (%.1f%%) %s: %s", total, progresstotal, percent, s, fname)
 
-        # files that we've indexed in the past but don't exist anymore
-        if files is None:
-            c.execute("SELECT docid, path FROM deletedocs");
-            for (docid, fname) in c:
-                printprogress("Deleting", fname)
-                remove_document(cu, docid)
-
-                deletes += 1
-
-        c.execute("SELECT docid, path, last_modified, size FROM updated_files;")
-        for (docid, fname, last_modified, size) in c:
-            printprogress("Updating %.2f" % (size/1024.0), fname)
-            try:
-                with get_bytes(fname, size) as bb:
-                    update_document(cu, docid, last_modified, bb)
-            except IOError as e:
-                if e.errno in (errno.ENOENT, errno.EPERM):
-                    logger.warning("Skipping %s: %s", fname, os.strerror(e.errno))
-                else:
-                    raise
-                continue
-            updates += 1
-
-        # new files to create
-        c.execute("SELECT path, dbpath, last_modified, size FROM created_files;")
-        for (fname, dbpath, last_modified, size) in c:
-            # is it safe to re-use the last_modified that we got before, or do
-            # we need to re-stat() the file? reusing it like this could make a
-            # race-condition whereby we never re-update that file
-            printprogress("Adding %.1fk" % (size/1024.0), fname)
-            try:
-                with get_bytes(fname, size) as bb:
-                    add_document(cu, dbpath, last_modified, bb)
-            except IOError as e:
-                if e.errno in (errno.ENOENT, errno.EPERM):
-                    logger.warning("Skipping %s: %s", fname, os.strerror(e.errno))
+        def skipped(fname, e):
+            if isinstance(e, IOError) and e.errno in (errno.ENOENT, errno.EPERM):
+                logger.warning("Skipping %s: %s", fname, os.strerror(e.errno))
+                return True
+            return False
+
+        # everything from here on is committed as we go, so an interrupted sync
+        # will pick up where it left off. the dirs cache is only updated at the
+        # end, so until then the next sync won't skip anything that we didn't
+        # get to
+        chunk = Chunker(conn)
+
+        with stats.phase('updates'):
+            updating = paged(c, """
+                SELECT odid, docid, path, last_modified, size, hash
+                  FROM updated_files
+                 WHERE odid > ?
+              ORDER BY odid
+                 LIMIT ?
+            """)
+            for (odid, docid, fname, last_modified, size, digest), doc, e in prepare_documents(updating, itemgetter(2, 4), jobs, with_trigrams, limits):
+                printprogress("Updating %.2f" % (size/1024.0), fname)
+                if e is not None:
+                    if skipped(fname, e):
+                        continue
+                    raise e
+                if doc.skipped is not None:
+                    # it may have been skipped before too, but its size may
+                    # have changed
+                    skip_document(cu, docid, last_modified, doc.digest, doc.skipped, min(size, MAX_FSIZE))
+                    stats.count('files skipped')
+                    skips += 1
+                elif doc.digest == digest:
+                    # only the mtime changed (a checkout or a touch)
+                    touch_document(cu, docid, last_modified)
+                    touches += 1
                 else:
-                    raise
-                continue
-            news += 1
-
-        logger.info("%d new documents, %d deletes, %d updates in %.2fs", news, deletes, updates, time.time()-start)
+                    update_document(cu, docid, last_modified, doc.content, doc.digest, doc.trigrams, doc.lines,
+                                    doc.segments)
+                updates += 1
+                chunk.done()
+
+        def moved(dbpath, last_modified, doc):
+            # if this is the same as a file that's gone missing, then it was
+            # probably renamed or moved. rather than reindexing it we can just
+            # point the old document at the new path
+            if scope is None:
+                return False
+            cu.execute("SELECT docid FROM deletedocs WHERE hash = ? LIMIT 1", (doc.digest,))
+            row = cu.fetchone()
+            if row is None:
+                return False
+            docid, = row
+            move_document(cu, docid, dbpath, last_modified)
+            cu.execute("DELETE FROM deletedocs WHERE docid = ?", (docid,))
+            return True
+
+        with stats.phase('inserts'):
+            # new files to create
+            def created():
+                creating = paged(c, """
+                    SELECT rowid, path, dbpath, last_modified, size
+                      FROM createdocs
+                     WHERE rowid > ?
+                  ORDER BY rowid
+                     LIMIT ?
+                """)
+                for (rowid, fname, dbpath, last_modified, size), doc, e in prepare_documents(creating, itemgetter(1, 4), jobs, with_trigrams, limits):
+                    # is it safe to re-use the last_modified that we got before, or do
+                    # we need to re-stat() the file? reusing it like this could make a
+                    # race-condition whereby we never re-update that file
+                    printprogress("Adding %.1fk" % (size/1024.0), fname)
+                    if e is not None:
+                        if skipped(fname, e):
+                            continue
+                        raise e
+                    yield dbpath, last_modified, size, doc
+
+            def skip(dbpath, last_modified, size, doc):
+                add_skipped(cu, dbpath, last_modified, doc.digest, doc.skipped, min(size, MAX_FSIZE))
+                stats.count('files skipped')
+
+            if tnews < BULK_THRESHOLD:
+                for dbpath, last_modified, size, doc in created():
+                    if moved(dbpath, last_modified, doc):
+                        moves += 1
+                    elif doc.skipped is not None:
+                        skip(dbpath, last_modified, size, doc)
+                        news += 1
+                        skips += 1
+                    else:
+                        add_document(cu, dbpath, last_modified, doc.content, doc.digest, doc.trigrams, doc.lines,
+                                     doc.segments)
+                        news += 1
+                    chunk.done()
+
+            else:
+                empty = not cu.execute("SELECT 1 FROM files LIMIT 1").fetchall()
+                logger.debug("Bulk loading %d files", tnews)
+
+                with bulkload(cu, empty=empty):
+                    batch = []
+                    batchsize = 0
+                    for dbpath, last_modified, size, doc in created():
+                        if moved(dbpath, last_modified, doc):
+                            moves += 1
+                            chunk.done()
+                            continue
+                        if doc.skipped is not None:
+                            skip(dbpath, last_modified, size, doc)
+                            news += 1
+                            skips += 1
+                            chunk.done()
+                            continue
+                        if doc.segments is not None:
+                            # too big to hold on to until the batch is done
+                            add_document(cu, dbpath, last_modified, doc.content, doc.digest, doc.trigrams, doc.lines,
+                                         doc.segments)
+                            news += 1
+                            chunk.done()
+                            continue
+                        # the buffer is only good until we ask for the next one
+                        batch.append((dbpath, last_modified, str(doc.content), doc.digest, doc.trigrams, doc.lines))
+                        batchsize += len(doc.content)
+                        news += 1
+
+                        if len(batch) >= BULK_BATCH or batchsize >= BULK_BATCH_BYTES:
+                            add_documents(cu, batch)
+                            chunk.done(len(batch))
+                            batch = []
+                            batchsize = 0
+
+                    if batch:
+                        add_documents(cu, batch)
+                        chunk.done(len(batch))
+
+        with stats.phase('deletes'):
+            # files that we've indexed in the past but don't exist anymore (and
+            # that we didn't find under another name)
+            if scope is not None:
+                deleting = paged(c, """
+                    SELECT docid, path
+                      FROM deletedocs
+                     WHERE docid > ?
+                  ORDER BY docid
+                     LIMIT ?
+                """)
+                for (docid, fname) in deleting:
+                    printprogress("Deleting", fname)
+                    remove_document(cu, docid)
+
+                    deletes += 1
+                    chunk.done()
 
         cu.execute("DROP VIEW updated_files;")
-        cu.execute("DROP VIEW created_files;")
+        cu.execute("DROP TABLE createdocs;")
         cu.execute("DROP TABLE IF EXISTS deletedocs;")
-        cu.execute("DROP TABLE ondisk;")
+
+    return news, moves, deletes, updates, touches, skips
@@ -0,0 +1,123 @@
+"""
+an optional trigram index to speed up regex searches.
+
+files_trigrams is an fts4 table with a row for each document in files_fts,
+whose text is the set of distinct 3-byte sequences that appear in it. Each
+trigram is hex-encoded so that fts4's tokeniser leaves it alone. To run a
+regex search we work out which literal strings any match must contain, look
+up the documents that contain all of their trigrams, and only run the regex
+against those.
+"""
+
+import binascii
+import sre_parse
+import sre_constants
+
+from ftsdb import logger, Cursor, getconfig, setconfig
+
+# don't make the MATCH any bigger than this. every trigram narrows the
+# candidates, but each one costs another doclist to read
+MAX_QUERY_TRIGRAMS = 24
+
+def trigrams_enabled(c):
+    return bool(getconfig(c, 'trigrams', 0))
+
+def trigrams(content):
+    """
+    the text to store in files_trigrams for a document
+    """
+    grams = set(content[x:x+3] for x in xrange(len(content)-2))
+    return ' '.join(binascii.hexlify(g) for g in grams)
+
+def _literals(items, runs):
+    # appends to runs the literal strings that every match of the parsed
+    # items must contain
+    run = []
+
+    def flush():
+        if run:
+            runs.append(''.join(run))
+            del run[:]
+
+    for op, av in items:
+        if op == sre_constants.LITERAL and av < 256:
+            run.append(chr(av))
+
+        elif op == sre_constants.SUBPATTERN:
+            flush()
+            _literals(av[1], runs)
+
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+            # x{2,} must contain at least one x
+            flush()
+            lo, hi, sub = av
+            if lo >= 1:
+                _literals(sub, runs)
+
+        else:
+            # branches, character classes, anchors and the like. we could do
+            # better with some of them, but it's always safe to know less
+            flush()
+
+    flush()
+
+def regex_trigrams(pattern):
+    """
+    the trigrams that any document matching the regex must contain, or an
+    empty list if we can't tell
+    """
+    try:
+        parsed = sre_parse.parse(pattern)
+    except (sre_constants.error, TypeError, ValueError, OverflowError):
+        # the search will report it, or it's something that re2 understands
+        # that we don't
+        return []
+
+    if parsed.pattern.flags & sre_constants.SRE_FLAG_IGNORECASE:
+        return []
+
+    runs = []
+    _literals(list(parsed), runs)
+
+    grams = []
+    seen = set()
+    for run in runs:
+        for x in xrange(len(run)-2):
+            g = run[x:x+3]
+            if g not in seen:
+                seen.add(g)
+                grams.append(g)
+
+    return grams[:MAX_QUERY_TRIGRAMS]
+
+def trigram_query(pattern):
+    """
+    the files_trigrams MATCH expression for the regex, or None if it would
+    need a full scan
+    """
+    grams = regex_trigrams(pattern)
+    if not grams:
+        return None
+    return ' '.join(binascii.hexlify(g) for g in grams)
+
+def enable_trigrams(conn):
+    with Cursor(conn) as c, Cursor(conn) as cu:
+        setconfig(c, 'trigrams', 1)
+
+        # index whatever's already there
+        count = 0
+        c.execute("""
+            SELECT docid, body
+              FROM files_fts
+             WHERE docid NOT IN (SELECT docid FROM files_trigrams)
+        """)
+        for docid, body in c:
+            cu.execute("INSERT INTO files_trigrams(docid, grams) VALUES(?, ?)",
+                       (docid, trigrams(body or '')))
+            count += 1
+        logger.info("Built trigrams for %d documents", count)
+
+def disable_trigrams(conn):
+    with Cursor(conn) as c:
+        setconfig(c, 'trigrams', 0)
+        c.execute("DELETE FROM files_trigrams;")
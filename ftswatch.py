@@ -0,0 +1,330 @@
+"""
+keep the index up to date as files change, using inotify
+"""
+
+import os
+import os.path
+import errno
+import stat
+import struct
+import select
+import time
+import ctypes
+import ctypes.util
+
+from ftsdb import logger, Cursor, _db_name
+from ftssync import sync, sync_paths
+from ftsexclude import load_exclusions
+
+# from <sys/inotify.h>
+IN_MODIFY      = 0x00000002
+IN_ATTRIB      = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM  = 0x00000040
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_DELETE      = 0x00000200
+IN_Q_OVERFLOW  = 0x00004000
+IN_IGNORED     = 0x00008000
+IN_ONLYDIR     = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR       = 0x40000000
+IN_CLOEXEC     = 0x00080000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE
+              | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+              | IN_ONLYDIR | IN_DONT_FOLLOW)
+
+_event = struct.Struct('iIII')
+
+# wait for this many seconds of quiet before applying changes, so that a burst
+# of events (a checkout, a build) is applied all at once
+DEBOUNCE = 0.5
+
+# but don't let a constant trickle of events hold them up for longer than this
+MAX_LATENCY = 5.0
+
+# apply this many changed paths per transaction
+WATCH_BATCH = 500
+
+# how often to do a full sync when we couldn't watch everything
+RESCAN_INTERVAL = 300
+
+class NoInotify(Exception):
+    pass
+
+class Inotify(object):
+    """
+    a minimal ctypes wrapper around the inotify syscalls
+    """
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        try:
+            init1 = libc.inotify_init1
+        except AttributeError:
+            raise NoInotify()
+
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+        self._rm_watch = libc.inotify_rm_watch
+        self._rm_watch.argtypes = (ctypes.c_int, ctypes.c_int)
+
+        self.fd = init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise NoInotify(os.strerror(ctypes.get_errno()))
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        wd = self._add_watch(self.fd, path, mask)
+        if wd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e), path)
+        return wd
+
+    def rm_watch(self, wd):
+        # it may already be gone, in which case we don't care
+        self._rm_watch(self.fd, wd)
+
+    def read(self, timeout=None):
+        """
+        return a list of (wd, mask, cookie, name) waiting for at most timeout
+        seconds for at least one
+        """
+        try:
+            ready, _, _ = select.select([self.fd], [], [], timeout)
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+        if not ready:
+            return []
+
+        buf = os.read(self.fd, 64*1024)
+        events = []
+        pos = 0
+        while pos < len(buf):
+            wd, mask, cookie, length = _event.unpack_from(buf, pos)
+            pos += _event.size
+            name = buf[pos:pos+length].rstrip('\0')
+            pos += length
+            events.append((wd, mask, cookie, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+class Watcher(object):
+    def __init__(self, conn, root, prefix, jobs=1):
+        self.conn = conn
+        self.root = root
+        self.prefix = prefix
+        self.jobs = jobs
+
+        self.inotify = None
+        self.wds = {} # wd -> dbpath of the directory
+        self.dirs = {} # dbpath -> wd
+
+        # whether we weren't able to watch everything and have to poll
+        self.polling = False
+
+        with Cursor(conn) as c:
+            self.exclusions = load_exclusions(c)
+
+    def fname(self, dbpath):
+        return os.path.join(self.root, dbpath) if dbpath else self.root
+
+    def add_watches(self, top):
+        """
+        watch top and every directory under it that isn't excluded
+        """
+        stack = [top]
+        while stack:
+            dbdir = stack.pop()
+            try:
+                wd = self.inotify.add_watch(self.fname(dbdir))
+            except OSError as e:
+                if e.errno == errno.ENOSPC:
+                    if not self.polling:
+                        logger.warning("Ran out of inotify watches (see /proc/sys/fs/inotify/max_user_watches). "
+                                       "Falling back to a full sync every %ds", RESCAN_INTERVAL)
+                    self.polling = True
+                    return
+                elif e.errno in (errno.ENOENT, errno.ENOTDIR, errno.EACCES):
+                    # gone already or not for us
+                    continue
+                raise
+
+            self.wds[wd] = dbdir
+            self.dirs[dbdir] = wd
+
+            try:
+                names = os.listdir(self.fname(dbdir))
+            except OSError as e:
+                if e.errno in (errno.ENOENT, errno.ENOTDIR, errno.EACCES):
+                    continue
+                raise
+
+            for name in names:
+                dbpath = os.path.join(dbdir, name) if dbdir else name
+                if self.exclusions and not self.exclusions.allow(name, dbpath):
+                    continue
+                try:
+                    st = os.lstat(self.fname(dbpath))
+                except OSError:
+                    continue
+                if stat.S_ISDIR(st.st_mode):
+                    if self.exclusions and not self.exclusions.allow_dir(name, dbpath):
+                        continue
+                    stack.append(dbpath)
+
+    def forget_watches(self, top):
+        """
+        stop watching top and everything under it (e.g. because it was moved
+        away, and the watches would follow it)
+        """
+        for dbdir in list(self.dirs):
+            if dbdir == top or dbdir.startswith(top + '/'):
+                wd = self.dirs.pop(dbdir)
+                del self.wds[wd]
+                self.inotify.rm_watch(wd)
+
+    def handle(self, events, pending):
+        """
+        turn inotify events into the set of dbpaths that need syncing. returns
+        whether we need a full sync instead
+        """
+        rescan = False
+        for wd, mask, cookie, name in events:
+            if mask & IN_Q_OVERFLOW:
+                logger.warning("inotify queue overflowed, doing a full sync")
+                rescan = True
+                continue
+
+            dbdir = self.wds.get(wd)
+            if dbdir is None:
+                continue
+
+            if mask & IN_IGNORED:
+                # the directory was deleted (and we'll have seen that in its
+                # parent)
+                del self.wds[wd]
+                self.dirs.pop(dbdir, None)
+                continue
+
+            if not name or name.startswith(_db_name):
+                # our own database and its journals
+                continue
+
+            dbpath = os.path.join(dbdir, name) if dbdir else name
+
+            if mask & IN_ISDIR and not mask & (IN_CREATE | IN_MOVED_TO | IN_MOVED_FROM | IN_DELETE):
+                # syncing a directory means syncing everything under it, so
+                # don't do it just because it was chmodded
+                continue
+
+            pending.add(dbpath)
+
+            if mask & IN_ISDIR:
+                if mask & IN_MOVED_FROM:
+                    self.forget_watches(dbpath)
+                elif mask & (IN_CREATE | IN_MOVED_TO):
+                    # watch it right away so we don't miss anything happening
+                    # inside of it. whatever's already there will be picked
+                    # up by syncing the whole directory
+                    if self.exclusions and not (self.exclusions.allow(name, dbpath)
+                                                and self.exclusions.allow_dir(name, dbpath)):
+                        continue
+                    self.add_watches(dbpath)
+
+        return rescan
+
+    def apply(self, pending):
+        # syncing a directory syncs everything under it, so we don't need to
+        # mention them too
+        paths = []
+        for dbpath in sorted(pending):
+            if paths and dbpath.startswith(paths[-1] + '/'):
+                continue
+            paths.append(dbpath)
+
+        for x in xrange(0, len(paths), WATCH_BATCH):
+            batch = paths[x:x+WATCH_BATCH]
+            logger.debug("Syncing %d changed paths", len(batch))
+            with self.conn:
+                sync_paths(self.conn, self.root, batch, jobs=self.jobs)
+
+    def rescan(self):
+        with self.conn:
+            sync(self.conn, self.root, self.prefix, jobs=self.jobs)
+        with Cursor(self.conn) as c:
+            self.exclusions = load_exclusions(c)
+
+    def run(self):
+        logger.info("Syncing before watching")
+        self.rescan()
+
+        try:
+            self.inotify = Inotify()
+        except NoInotify as e:
+            logger.warning("inotify isn't available (%s). Falling back to a full sync every %ds",
+                           e, RESCAN_INTERVAL)
+            self.polling = True
+
+        if self.inotify is not None:
+            self.add_watches(self.prefix)
+            logger.info("Watching %d directories", len(self.dirs))
+
+        pending = set()
+        first_event = last_event = None
+        last_rescan = time.time()
+
+        try:
+            while True:
+                now = time.time()
+
+                if pending:
+                    timeout = min(last_event + DEBOUNCE, first_event + MAX_LATENCY) - now
+                elif self.polling:
+                    timeout = last_rescan + RESCAN_INTERVAL - now
+                else:
+                    timeout = None
+
+                if self.inotify is not None:
+                    events = self.inotify.read(max(timeout, 0) if timeout is not None else None)
+                else:
+                    time.sleep(max(timeout, 0))
+                    events = []
+
+                now = time.time()
+
+                if events:
+                    if self.handle(events, pending):
+                        pending.clear()
+                        first_event = last_event = None
+                        self.rescan()
+                        last_rescan = time.time()
+                        continue
+                    if pending:
+                        last_event = now
+                        if first_event is None:
+                            first_event = now
+
+                if pending and (now >= last_event + DEBOUNCE
+                                or now >= first_event + MAX_LATENCY):
+                    self.apply(pending)
+                    pending.clear()
+                    first_event = last_event = None
+
+                if self.polling and now >= last_rescan + RESCAN_INTERVAL:
+                    self.rescan()
+                    last_rescan = time.time()
+
+        finally:
+            if self.inotify is not None:
+                self.inotify.close()
+
+def watch(conn, root, prefix, jobs=1):
+    """
+    keep the index of root/prefix in sync with the disk until interrupted
+    """
+    Watcher(conn, root, prefix, jobs=jobs).run()
@@ -68,3 +68,23 @@ pushd rando > /dev/null
 
 popd > /dev/null
 
+
+echo test that a file removed with ftsindex comes back on the next sync
+somefile=rando/$(ls rando | unsort | head -n 1)
+# made up here so that this script doesn't match it
+word=removed$(date +%s)
+echo "$word" >> $somefile
+python2.7 - "$somefile" "$word" <<'PYTHON'
+import sys
+from ftsindex import Index
+path, word = sys.argv[1:]
+with Index('.') as index:
+    index.sync()
+    found = lambda: [sr.filename for sr in index.search([word])]
+    assert found() == [path], found()
+    assert index.remove(path)
+    assert found() == [], found()
+    # the directory hasn't changed, so this is the sync that could miss it
+    index.sync(trust_dirs=True)
+    assert found() == [path], found()
+PYTHON